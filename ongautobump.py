@@ -1,44 +1,55 @@
 #!/usr/bin/env -S uv run --script --quiet
 import argparse
+import atexit
+import bisect
+import functools
 import io
 import json
+import logging
 import os
+import random
 import re
 import sys
-import gspread
-import select
+import http.server
+import queue
+import sqlite3
+import threading
 import time
-import traceback
+from abc import ABC, abstractmethod
+from collections import Counter, deque
 from datetime import datetime, timedelta
 from enum import IntEnum
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, List, NamedTuple, Optional
+from urllib.parse import parse_qs, urlsplit
 from zoneinfo import ZoneInfo
 
 from tdvutil.argparse import CheckFile
 
+processstart = time.monotonic()    # for the time to "Ready for data"
+
 # NOTE: You will need to set up a file with your google cloud credentials
 # as noted in the documentation for the "gspread" module
 
-# event queue - this is to keep from making too many API calls per minute
-rowqueue = [ ]
-hypequeue = [ ]
-supportqueue = [ ]
-detailupdate = [ ]
-songqueue = [ ]
-
-# Starting row
-row = 2
-rowsearchwidth = 50 # Size of the initial search
-
 # Track new rows
 newrowcount = 100
 newrowused = 100
-lastrow = 0
-ordercount = 0
 
 # Arguement Parsing
-def parse_args() -> argparse.Namespace:
+def parse_target(text):
+    parts = text.split(':')
+    if len(parts) < 2 or len(parts) > 3 or not all(parts):
+        raise argparse.ArgumentTypeError(f'expected STATEFILE:SHEET[:WORKSHEET], got {text}')
+    return parts[0], parts[1], parts[2] if len(parts) == 3 else "Support"
+
+def parse_when(text):
+    # "2026-06-11" or "2026-06-11 22:35:37", compared as text against the log
+    try:
+        return datetime.fromisoformat(text).strftime('%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected YYYY-MM-DD[ HH:MM:SS], got {text}')
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser(
         description="Search the onglog via discord",
     )
@@ -71,7 +82,237 @@ def parse_args() -> argparse.Namespace:
         help="State file used to remember last location in sheet"
     )
 
-    parsed_args = parser.parse_args()
+    parser.add_argument(
+        "--target",
+        type=parse_target,
+        action="append",
+        default=None,
+        help="STATEFILE:SHEET[:WORKSHEET] to write to, can be given more than once to fan out to several sheets "
+             "(SHEET is a google sheet identifier, or a file for --backend local; default: --statefile and --gsheets-id)"
+    )
+
+    parser.add_argument(
+        "--spool",
+        type=Path,
+        default=None,
+        help="write-ahead spool of pending rows (default: the state file with a .spool extension)"
+    )
+
+    parser.add_argument(
+        "--no-spool",
+        action="store_true",
+        help="don't keep a spool, pending rows are lost if the process dies"
+    )
+
+    parser.add_argument(
+        "--read-quota",
+        type=int,
+        default=60,
+        help="sheet read requests per minute to pace ourselves to"
+    )
+
+    parser.add_argument(
+        "--write-quota",
+        type=int,
+        default=60,
+        help="sheet write requests per minute to pace ourselves to"
+    )
+
+    parser.add_argument(
+        "--max-lines",
+        type=int,
+        default=10000,
+        help="lines read but not yet parsed before we stop reading stdin"
+    )
+
+    parser.add_argument(
+        "--max-failures",
+        type=int,
+        default=10,
+        help="give up and exit after this many failed writes in a row"
+    )
+
+    parser.add_argument(
+        "--flush-min-delay",
+        type=float,
+        default=0.25,
+        help="seconds to hold new rows at least, so the rest of a burst can join them"
+    )
+
+    parser.add_argument(
+        "--flush-max-delay",
+        type=float,
+        default=5.0,
+        help="seconds to hold new rows at most, however busy the log is"
+    )
+
+    parser.add_argument(
+        "--flush-idle",
+        type=float,
+        default=0.5,
+        help="seconds without a new line before what's waiting is written"
+    )
+
+    parser.add_argument(
+        "--flush-rows",
+        type=int,
+        default=100,
+        help="rows waiting that are written straight away"
+    )
+
+    parser.add_argument(
+        "--mirror-ttl",
+        type=float,
+        default=60.0,
+        help="seconds to trust the local copy of the end of the sheet before checking it again"
+    )
+    parser.add_argument(
+        "--follow",
+        type=str,
+        default=None,
+        help="read this log file directly instead of stdin, resuming where the last run stopped"
+    )
+    parser.add_argument(
+        "--follow-backlog",
+        type=int,
+        default=100,
+        help="lines from the end of the followed log to read when there is no saved position"
+    )
+    parser.add_argument(
+        "--follow-interval",
+        type=float,
+        default=0.25,
+        help="seconds between checks of the followed log for new lines"
+    )
+    parser.add_argument(
+        "--import",
+        dest="import_log",
+        type=Path,
+        default=None,
+        action=CheckFile(must_exist=True),
+        help="catch up from this log file in one go and exit, instead of reading new lines as they come"
+    )
+    parser.add_argument(
+        "--since",
+        type=parse_when,
+        default=None,
+        help="with --import, skip lines from before this time (YYYY-MM-DD[ HH:MM:SS])"
+    )
+    parser.add_argument(
+        "--until",
+        type=parse_when,
+        default=None,
+        help="with --import, stop at lines from this time on (YYYY-MM-DD[ HH:MM:SS])"
+    )
+    parser.add_argument(
+        "--import-chunk",
+        type=int,
+        default=5000,
+        help="rows written per request with --import"
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="serve Prometheus metrics on this port at /metrics"
+    )
+    parser.add_argument(
+        "--metrics-host",
+        type=str,
+        default="127.0.0.1",
+        help="address to serve metrics on"
+    )
+    parser.add_argument(
+        "--stats-interval",
+        type=float,
+        default=0,
+        help="seconds between stats lines in the log (0 for none)"
+    )
+    parser.add_argument(
+        "--song-match-expiry",
+        type=float,
+        default=0.0,
+        help="seconds a song request and the support paying for it can be apart and still match (0 for the whole stream)"
+    )
+
+    parser.add_argument(
+        "--log-level",
+        choices=["debug", "info", "warning", "error"],
+        default="info",
+        help="least important messages to log (debug adds every line read and every row being written)"
+    )
+
+    parser.add_argument(
+        "--log-json",
+        action="store_true",
+        help="log one JSON object per line instead of text"
+    )
+
+    parser.add_argument(
+        "--log-burst",
+        type=int,
+        default=20,
+        help="times the same message is logged every 10 seconds, the rest are counted (0 for no limit)"
+    )
+
+    parser.add_argument(
+        "--backend",
+        choices=["gspread", "local"],
+        default="gspread",
+        help="sheet backend: the live google sheet, or an in-memory stand-in for load testing"
+    )
+
+    parser.add_argument(
+        "--local-sheet",
+        type=Path,
+        default=None,
+        help="tab seperated file to seed the local sheet from, and save it back to on exit"
+    )
+
+    parser.add_argument(
+        "--local-latency",
+        type=float,
+        default=0.0,
+        help="seconds of simulated latency per local sheet API call"
+    )
+
+    parser.add_argument(
+        "--local-read-quota",
+        type=int,
+        default=60,
+        help="local sheet read requests allowed per minute before returning 429"
+    )
+
+    parser.add_argument(
+        "--local-write-quota",
+        type=int,
+        default=60,
+        help="local sheet write requests allowed per minute before returning 429"
+    )
+
+    parser.add_argument(
+        "--local-error-rate",
+        type=float,
+        default=0.0,
+        help="fraction of local sheet API calls that fail with an injected 429/5xx error"
+    )
+
+    parser.add_argument(
+        "--local-seed",
+        type=int,
+        default=None,
+        help="random seed for local sheet error injection, for reproducible runs"
+    )
+
+    parsed_args = parser.parse_args(argv)
+
+    if parsed_args.spool is not None and parsed_args.target is not None and len(parsed_args.target) > 1:
+        parser.error("--spool only works with one target, each target keeps its own next to its state file")
+
+    if parsed_args.import_log is not None and parsed_args.follow is not None:
+        parser.error("--import and --follow can't be used together")
+    if parsed_args.import_log is None and (parsed_args.since is not None or parsed_args.until is not None):
+        parser.error("--since and --until only work with --import")
 
     if parsed_args.gsheets_credentials_file is None:
         parsed_args.gsheets_credentials_file = Path(
@@ -159,385 +400,2456 @@ def parse_args() -> argparse.Namespace:
  7 Detail.  This is mainly for the hyperlink for song requets, but also for other mod notes.
 """
 
-def remove_inside_quotes(input_string):
-    # 1. Find the first occurrence of "(url," to isolate the parts
-    # This ensures we split at the correct comma even if the title has commas.
-    if '(' not in input_string and ',' in input_string:
-        print(f'Unexpected input: {input_string} - Skipping. Expected format: =HYPERLINK("url", "title")')
-        return input_string # Return original if format is unexpected
+# Sheet backends
+#
+# findnextrow() and main() only ever talk to the Support worksheet through
+# the handful of calls below, so anything implementing them can stand in for
+# the google sheet.  GspreadSheet is the real thing, LocalSheet is an
+# in-memory fake used for load testing without burning API quota.
+
+def a1_to_rowcol(label):
+    # "H12" -> (12, 8).  Column only labels like "A" give a row of None
+    match = re.match(r'^([A-Za-z]+)(\d*)$', label)
+    if not match:
+        raise ValueError(f'Bad cell label: {label}')
+    col = 0
+    for c in match.group(1).upper():
+        col = col*26 + ord(c) - ord('A') + 1
+    if match.group(2):
+        return int(match.group(2)), col
+    return None, col
+
+def rowcol_to_a1(rownum, col):
+    letters = ''
+    while col > 0:
+        col, rem = divmod(col - 1, 26)
+        letters = chr(ord('A') + rem) + letters
+    return f'{letters}{rownum}'
+
+
+class SheetError(Exception):
+    # Mirrors the parts of gspread's APIError that we look at
+    def __init__(self, code, message="", retry_after=None):
+        super().__init__(f'{code}: {message}')
+        self.code = code
+        self.retry_after = retry_after
+
+
+class SheetBackend(ABC):
+    def __init__(self):
+        # API calls made, by method name
+        self.calls = Counter()
+
+    @abstractmethod
+    def get(self, range_name, pad_values=False):
+        pass
+
+    @abstractmethod
+    def batch_update(self, data, value_input_option=None):
+        # data is a list of {'range': 'A1:B2', 'values': [[...]]}, all sent in one request
+        pass
+
+    @property
+    @abstractmethod
+    def row_count(self):
+        pass
+
+    @abstractmethod
+    def add_rows(self, rows):
+        pass
+
+    def reopen(self):
+        # Called after a failure in case the connection went stale
+        pass
+
+    def close(self):
+        pass
+
+
+class GspreadSheet(SheetBackend):
+    # open_by_key() and worksheet() each read the spreadsheet metadata, so the
+    # worksheet is built from one read instead, and the ids and sizes from it
+    # are kept in cache so a restart doesn't have to read it at all.  The
+    # row count is the only part that goes stale, so the first time it's
+    # wanted after starting from the cache the metadata is read again.
+    def __init__(self, gc, spreadsheet_id, worksheet_name="Support", cache=None):
+        super().__init__()
+        self.gc = gc
+        self.spreadsheet_id = spreadsheet_id
+        self.worksheet_name = worksheet_name
+        self.cache = cache
+        self.cached = False
+        if not self.opencached():
+            self.reopen()
+
+    def build(self, spreadsheet, worksheet):
+        # Nothing used here needs the Spreadsheet object, and making one
+        # would read the metadata again
+        import gspread
+        self.spreadsheet = dict(spreadsheet)
+        self.worksheet = gspread.Worksheet(None, dict(worksheet), spreadsheet_id=self.spreadsheet_id, client=self.gc.http_client)
+
+    def opencached(self):
+        if self.cache is None:
+            return False
+        try:
+            saved = json.loads(self.cache.read_text())
+            if saved['spreadsheet']['id'] != self.spreadsheet_id or saved['worksheet']['title'] != self.worksheet_name:
+                return False
+            self.build(saved['spreadsheet'], saved['worksheet'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        self.cached = True
+        log.debug(f'Using cached sheet details from {self.cache}')
+        return True
+
+    def reopen(self):
+        # The same client, and so the same connections, every time
+        import gspread
+        self.calls['fetch_sheet_metadata'] += 1
+        metadata = self.gc.http_client.fetch_sheet_metadata(self.spreadsheet_id)
+        spreadsheet = dict(metadata['properties'], id=self.spreadsheet_id)
+        for sheet in metadata['sheets']:
+            if sheet['properties']['title'] == self.worksheet_name:
+                worksheet = sheet['properties']
+                break
+        else:
+            raise gspread.WorksheetNotFound(self.worksheet_name)
+        self.build(spreadsheet, worksheet)
+        self.cached = False
+        self.savecache()
+
+    def savecache(self):
+        if self.cache is None:
+            return
+        try:
+            self.cache.write_text(json.dumps({'spreadsheet': self.spreadsheet,
+                                              'worksheet': self.worksheet._properties}))
+        except OSError as e:
+            log.warning(f'Could not save sheet details to {self.cache}: {e}')
+
+    def get(self, range_name, pad_values=False):
+        self.calls['get'] += 1
+        return self.worksheet.get(range_name, pad_values=pad_values)
+
+    def batch_update(self, data, value_input_option=None):
+        self.calls['batch_update'] += 1
+        return self.worksheet.batch_update(data, value_input_option=value_input_option)
+
+    @property
+    def row_count(self):
+        # From the worksheet metadata, no API call unless that came from the cache
+        if self.cached:
+            self.reopen()
+        return self.worksheet.row_count
+
+    def add_rows(self, rows):
+        self.calls['add_rows'] += 1
+        result = self.worksheet.add_rows(rows)
+        self.savecache()
+        return result
+
+
+class LocalSheet(SheetBackend):
+    # Rough model of the Sheets API limits: a per minute quota for reads and
+    # for writes, a fixed latency per call, and randomly injected errors.
+    def __init__(self, path=None, latency=0.0, read_quota=60, write_quota=60, error_rate=0.0, seed=None, width=8):
+        super().__init__()
+        self.path = path
+        self.latency = latency
+        self.quota = {'read': read_quota, 'write': write_quota}
+        self.recent = {'read': deque(), 'write': deque()}
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.width = width
+        self.injected = deque()   # error codes to fail the next calls with
+        self.cells = [["Date", "Order", "Gifter", "Member", "Type", "Amount", "Status", "Detail"]]
+        if path is not None and path.exists():
+            self.cells = [line.rstrip('\n').split('\t') for line in path.read_text().splitlines()]
+        self.gridrows = max(1000, len(self.cells))
+
+    def fail_next(self, code, count=1):
+        self.injected.extend([code]*count)
+
+    def _call(self, method, kind):
+        self.calls[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.injected:
+            raise SheetError(self.injected.popleft(), f'injected failure in {method}')
+        if self.error_rate and self.random.random() < self.error_rate:
+            code = self.random.choice([429, 500, 503])
+            raise SheetError(code, f'random failure in {method}')
+        now = time.monotonic()
+        recent = self.recent[kind]
+        while recent and recent[0] <= now - 60:
+            recent.popleft()
+        if len(recent) >= self.quota[kind]:
+            raise SheetError(429, f'Quota exceeded for {kind} requests per minute', retry_after=recent[0] + 60 - now)
+        recent.append(now)
+
+    def _row(self, rownum):
+        while len(self.cells) < rownum:
+            self.cells.append([])
+        return self.cells[rownum-1]
+
+    def _set(self, rownum, col, value):
+        cells = self._row(rownum)
+        while len(cells) < col:
+            cells.append('')
+        cells[col-1] = str(value)
+
+    def get(self, range_name, pad_values=False):
+        self._call('get', 'read')
+        start, end = range_name.split(':')
+        startrow, startcol = a1_to_rowcol(start)
+        endrow, endcol = a1_to_rowcol(end)
+        if endrow is None:
+            endrow = len(self.cells)
+        data = []
+        for rownum in range(startrow, endrow+1):
+            cells = self.cells[rownum-1][startcol-1:endcol] if rownum <= len(self.cells) else []
+            while cells and cells[-1] == '':
+                cells = cells[:-1]
+            data.append(list(cells))
+        # Like the real API, trailing empty rows are not returned
+        while data and not data[-1]:
+            data.pop()
+        if pad_values:
+            for cells in data:
+                cells.extend(['']*(endcol-startcol+1-len(cells)))
+        return data
+
+    def batch_update(self, data, value_input_option=None):
+        self._call('batch_update', 'write')
+        # The whole request fails if any of it is off the end of the grid
+        for update in data:
+            rownum, col = a1_to_rowcol(update['range'].split(':')[0])
+            if rownum + len(update['values']) - 1 > self.gridrows:
+                raise SheetError(400, f'Range {update["range"]} exceeds grid limits. Max rows: {self.gridrows}')
+        for update in data:
+            rownum, col = a1_to_rowcol(update['range'].split(':')[0])
+            for i, values_row in enumerate(update['values']):
+                for j, value in enumerate(values_row):
+                    self._set(rownum+i, col+j, value)
+        return {'totalUpdatedCells': sum(len(values_row) for update in data for values_row in update['values'])}
+
+    @property
+    def row_count(self):
+        return self.gridrows
+
+    def add_rows(self, rows):
+        self._call('add_rows', 'write')
+        self.gridrows += rows
+
+    def close(self):
+        if self.path is not None:
+            self.path.write_text(''.join('\t'.join(cell.replace('\n', ' ') for cell in cells) + '\n' for cells in self.cells))
+
+
+def open_client(args):
+    # One authenticated client (and its connection pool) for every target.
+    # gspread and google-auth take a while to import, so that waits until
+    # we know we need them.
+    if args.backend == "local":
+        return None
+    import gspread
+    gc = gspread.service_account(filename=args.gsheets_credentials_file)
+    log.debug(f'Google client: {gc}')
+    return gc
+
+def open_backend(args, gc, sheet_id=None, worksheet="Support", cache=None):
+    if args.backend == "local":
+        # A target's sheet is the file to keep it in
+        path = Path(sheet_id) if sheet_id is not None else args.local_sheet
+        log.info(f'Using local sheet {path or "(in memory)"}')
+        return LocalSheet(path=path, latency=args.local_latency,
+                          read_quota=args.local_read_quota, write_quota=args.local_write_quota,
+                          error_rate=args.local_error_rate, seed=args.local_seed)
+
+    if sheet_id is None:
+        ONG_BUMP_SPREADSHEET_ID = "19zRJ-EIBsJr37l8HViPpGjEJvotfzzkFIKeyxLz6WYg"
     else:
-        new_string = input_string.replace('","','\n').replace('", "','\n').replace('" ,"','\n')
-        # new string should have two lines now
-        parts = new_string.split('\n')
+        ONG_BUMP_SPREADSHEET_ID = sheet_id
 
-    if len(parts) < 2:
-        print(f'Unexpected input: {input_string} - {len(parts)} {parts}')
-        return input_string # Return original if format is unexpected
+    ONG_BUMP_SPREADSHEET_URL = f"https://docs.google.com/spreadsheets/d/{ONG_BUMP_SPREADSHEET_ID}"
 
-    # part[0] will be something like: =HYPERLINK("https://youtu.be/c8LNPeVPMIo"
-    # part[1] will be something like:  "KIRBY KRACKLE "Ring Capacity" (Green Lantern Song) Official Music Video")
-    
-    url_part = parts[0].replace('"','').replace('HYPERLINK(','HYPERLINK("') + '"'
-
-    # Fix just the video if its not the full link
-    # Check if we have a simple YouTube ID (no https in URL part)
-    # print(f'url part: {url_part}')
-    if not '=HYPERLINK("https://' in url_part:
-        # Extract the video ID from the URL part
-        # The url_part should be something like: HYPERLINK("o5gIvu8sATQ"
-        # We need to extract just the video ID part and make it a full URL
-        match = re.search(r'\=HYPERLINK\("([^"]+)"', url_part)
+    log.info(f"Using Sheet: {ONG_BUMP_SPREADSHEET_URL} ({worksheet})")
+    # gsheet = gc.open("Test Copy of JonathanOng Bump Log")
+    return GspreadSheet(gc, ONG_BUMP_SPREADSHEET_ID, worksheet, cache)
+
+
+# API rate scheduling
+#
+# The Sheets API allows a fixed number of read and of write requests per
+# minute.  Each is modelled as a token bucket so flushes are paced to stay
+# under the quota, and when the API pushes back anyway (429s, 5xx) further
+# writes are held off with jittered exponential backoff while lines keep
+# being read and parsed.
+class TokenBucket:
+    def __init__(self, per_minute, burst=None):
+        self.nominal = per_minute / 60.0
+        self.rate = self.nominal
+        self.capacity = burst if burst is not None else max(1.0, per_minute / 6.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self, count=1, now=None):
+        # Seconds until count tokens are available
+        self.refill(now)
+        if self.tokens >= count:
+            return 0.0
+        return (count - self.tokens) / self.rate
+
+    def take(self, count=1, now=None):
+        self.refill(now)
+        self.tokens -= count
+
+    def slowdown(self):
+        # The quota we were told about isn't the quota we're getting
+        self.rate = max(self.nominal / 10, self.rate / 2)
+        self.tokens = min(self.tokens, 0.0)
+
+    def speedup(self):
+        self.rate = min(self.nominal, self.rate + self.nominal / 20)
+
+
+def retryafter(error):
+    # Seconds the API asked us to wait, if it said
+    value = getattr(error, 'retry_after', None)
+    response = getattr(error, 'response', None)
+    if value is None and response is not None:
+        value = getattr(response, 'headers', {}).get('Retry-After')
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+def errorcode(error):
+    code = getattr(error, 'code', None)
+    if code is None:
+        response = getattr(error, 'response', None)
+        code = getattr(response, 'status_code', None)
+    return code
+
+
+class RateScheduler:
+    def __init__(self, read_quota=60, write_quota=60, backoff_base=2.0, backoff_max=300.0, name=""):
+        self.name = name
+        self.buckets = {'read': TokenBucket(read_quota), 'write': TokenBucket(write_quota)}
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.random = random.Random()
+        self.failures = 0
+        self.blocked_until = 0.0
+
+    def wait(self, kind='write', now=None):
+        # Seconds until a request of this kind should be made
+        if now is None:
+            now = time.monotonic()
+        return max(0.0, self.blocked_until - now, self.buckets[kind].wait(now=now))
+
+    def ready(self, kind='write', now=None):
+        return self.wait(kind, now) == 0.0
+
+    def charge(self, before, after):
+        # Take tokens for the calls a sheet made between two copies of its counts
+        for method in after:
+            count = after[method] - before.get(method, 0)
+            if count > 0:
+                self.buckets['read' if method in ('get', 'fetch_sheet_metadata') else 'write'].take(count)
+
+    def succeeded(self):
+        self.failures = 0
+        for bucket in self.buckets.values():
+            bucket.speedup()
+
+    def failed(self, error, now=None):
+        # Returns how long we are backing off for
+        self.failures += 1
+        code = errorcode(error)
+        if code == 429:
+            for bucket in self.buckets.values():
+                bucket.slowdown()
+        delay = retryafter(error)
+        if delay is None:
+            # Full jitter so restarts and multiple copies don't retry in lockstep
+            delay = self.random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** self.failures))
+        self.blocked_until = (now if now is not None else time.monotonic()) + delay
+        metrics.inc('ongautobump_backoffs_total', code=str(code), target=self.name)
+        metrics.observe('ongautobump_backoff_seconds', delay, target=self.name)
+        return delay
+
+
+# Flush policy
+#
+# A burst (a gift bomb, a hype train) should go out as one write.  Rows are
+# held while lines keep coming in and written once the log has been quiet
+# for idle seconds, but never sooner than min_delay after the first of them
+# arrived so the rest of a burst can catch up, and never later than
+# max_delay so a busy stream still gets written.  Once size rows are waiting
+# there's no point holding them any longer.
+class FlushPolicy:
+    def __init__(self, min_delay=0.25, max_delay=5.0, idle=0.5, size=100):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.idle = idle
+        self.size = size
+
+    def due(self, rows, oldest, lastline, now=None):
+        # Returns (seconds to hold off, why it's due now)
+        if now is None:
+            now = time.monotonic()
+        if rows >= self.size:
+            return 0.0, 'size'
+        age = now - oldest
+        if age >= self.max_delay:
+            return 0.0, 'max_delay'
+        wait = max(self.min_delay - age, self.idle - (now - lastline))
+        if wait <= 0.0:
+            return 0.0, 'idle'
+        return min(wait, self.max_delay - age), None
+
+
+# Logging
+#
+# Everything goes through the "ongautobump" logger.  Records are queued and
+# written by one thread that takes everything waiting at once, so a burst of
+# lines costs one write and one flush instead of one for every message.
+# Below warning level, the same message is logged --log-burst times every ten
+# seconds; the rest are counted, and the count is logged once the ten seconds
+# are up or on exit.
+log = logging.getLogger('ongautobump')
+
+class RateLimit(logging.Filter):
+    def __init__(self, burst=20, period=10.0):
+        super().__init__()
+        self.burst = burst
+        self.period = period
+        self.lock = threading.Lock()
+        self.windows = {}    # message -> [window start, messages, dropped, last dropped record]
+        self.notes = []      # records saying how many were dropped, not written yet
+        self.swept = 0.0
+
+    def filter(self, record):
+        if self.burst <= 0 or record.levelno >= logging.WARNING:
+            return True
+        message = record.getMessage()
+        with self.lock:
+            if record.created - self.swept >= self.period:
+                self.sweep(record.created)
+            window = self.windows.get(message)
+            if window is None or record.created - window[0] >= self.period:
+                if window is not None:
+                    self.note(window)
+                window = self.windows[message] = [record.created, 0, 0, None]
+            window[1] += 1
+            if window[1] > self.burst:
+                window[2] += 1
+                window[3] = record
+                return False
+        return True
+
+    def sweep(self, now=None):
+        # Forget finished windows so one-off messages don't pile up
+        for message, window in list(self.windows.items()):
+            if now is None or now - window[0] >= self.period:
+                del self.windows[message]
+                self.note(window)
+        self.swept = now or 0.0
+
+    def note(self, window):
+        if window[2]:
+            record = logging.makeLogRecord(vars(window[3]))
+            record.msg = f'{record.getMessage()} ({window[2]} more like this not logged)'
+            record.args = None
+            self.notes.append(record)
+
+    def pending(self, final=False):
+        with self.lock:
+            if final:
+                self.sweep()
+            notes, self.notes = self.notes, []
+        return notes
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'level': record.levelname.lower(),
+                 'thread': record.threadName, 'message': record.getMessage()}
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class LogWriter(logging.Handler):
+    def __init__(self, stream, formatter, limit=None):
+        super().__init__()
+        self.stream = stream
+        self.setFormatter(formatter)
+        self.limit = limit
+        if limit is not None:
+            self.addFilter(limit)
+        self.records = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, name="log", daemon=True)
+        self.thread.start()
+
+    def emit(self, record):
+        if self.limit is not None:
+            for note in self.limit.pending():
+                self.records.put(note)
+        self.records.put(record)
+
+    def run(self):
+        while True:
+            records = [self.records.get()]
+            while True:
+                try:
+                    records.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+            text = ''.join(self.format(record) + '\n' for record in records if record is not None)
+            try:
+                self.stream.write(text)
+                self.stream.flush()
+            except (OSError, ValueError):
+                pass
+            if None in records:
+                return
+
+    def close(self):
+        # Everything queued so far is written before this returns
+        if self.thread.is_alive():
+            if self.limit is not None:
+                for note in self.limit.pending(final=True):
+                    self.records.put(note)
+            self.records.put(None)
+            self.thread.join(5.0)
+        super().close()
+
+def setuplogging(level="info", json_output=False, burst=20):
+    for handler in list(log.handlers):
+        log.removeHandler(handler)
+        handler.close()
+    handler = LogWriter(sys.stdout, JsonFormatter() if json_output else logging.Formatter('%(asctime)s %(levelname)s %(message)s'), RateLimit(burst))
+    log.addHandler(handler)
+    log.setLevel(level.upper())
+    log.propagate = False
+    atexit.register(handler.close)
+
+def closelogging():
+    for handler in list(log.handlers):
+        log.removeHandler(handler)
+        handler.close()
+
+
+# Metrics
+#
+# Counters, histograms and gauges in the Prometheus text format, served on
+# --metrics-port and summed up in the log every --stats-interval seconds.
+# Gauges are functions read when the metrics are, so the queues don't need
+# to report every change.
+LATENCY = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+PARSETIME = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.01, 0.1)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)    # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.kinds = {}         # name -> (kind, help, buckets)
+        self.values = {}        # name -> {labels: int or Histogram}
+        self.gauges = {}        # name -> function
+
+    def counter(self, name, help):
+        self.kinds[name] = ('counter', help, None)
+        self.values[name] = {}
+
+    def histogram(self, name, help, buckets=LATENCY):
+        self.kinds[name] = ('histogram', help, buckets)
+        self.values[name] = {}
+
+    def gauge(self, name, help, fn):
+        self.kinds[name] = ('gauge', help, None)
+        self.gauges[name] = fn
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items())) if labels else ()
+        with self.lock:
+            values = self.values[name]
+            values[key] = values.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items())) if labels else ()
+        with self.lock:
+            values = self.values[name]
+            if key not in values:
+                values[key] = Histogram(self.kinds[name][2])
+            values[key].observe(value)
+
+    def reset(self):
+        with self.lock:
+            for values in self.values.values():
+                values.clear()
+
+    def get(self, name, **labels):
+        # Counter value, or the Histogram, None if never touched
+        return self.values[name].get(tuple(sorted(labels.items())))
+
+    def render(self):
+        out = []
+        with self.lock:
+            for name, (kind, help, buckets) in self.kinds.items():
+                out.append(f'# HELP {name} {help}')
+                out.append(f'# TYPE {name} {kind}')
+                if kind == 'gauge':
+                    try:
+                        value = self.gauges[name]()
+                    except Exception as e:
+                        log.warning(f'Could not read {name}: {e}')
+                        continue
+                    # Per session gauges come back as {target: value}
+                    if isinstance(value, dict):
+                        out.extend(f'{name}{{target="{target}"}} {count}' for target, count in value.items())
+                    else:
+                        out.append(f'{name} {value}')
+                    continue
+                for key, value in sorted(self.values[name].items()):
+                    labels = ','.join(f'{label}="{text}"' for label, text in key)
+                    braced = f'{{{labels}}}' if labels else ''
+                    if kind == 'counter':
+                        out.append(f'{name}{braced} {value}')
+                        continue
+                    sep = ',' if labels else ''
+                    cumulative = 0
+                    for bound, count in zip(list(buckets) + ['+Inf'], value.counts):
+                        cumulative += count
+                        out.append(f'{name}_bucket{{{labels}{sep}le="{bound}"}} {cumulative}')
+                    out.append(f'{name}_sum{braced} {value.sum}')
+                    out.append(f'{name}_count{braced} {value.count}')
+        return '\n'.join(out) + '\n'
+
+    def summary(self):
+        # One line for the log, added up over all the sessions
+        with self.lock:
+            lines = sum(self.values['ongautobump_lines_total'].values())
+            calls = {}
+            for key, value in self.values['ongautobump_api_seconds'].items():
+                count, seconds = calls.get(dict(key)['method'], (0, 0.0))
+                calls[dict(key)['method']] = (count + value.count, seconds + value.sum)
+            api = ' '.join(f'{method}={count} ({seconds / count:.2f}s avg)' for method, (count, seconds) in sorted(calls.items()))
+            lags = list(self.values['ongautobump_event_to_sheet_seconds'].values())
+            backoffs = sum(self.values['ongautobump_backoffs_total'].values())
+            events = ' '.join(f'{dict(key)["type"]}={value}' for key, value in sorted(self.values['ongautobump_events_total'].items()))
+        depths = []
+        for name, fn in self.gauges.items():
+            value = fn()
+            if isinstance(value, dict):
+                value = sum(value.values())
+            depths.append(f'{name[len("ongautobump_"):]}={round(value, 2) if isinstance(value, float) else value}')
+        text = f'Stats: {lines} lines, events {events or "none"}, api {api or "none"}, {backoffs} backoffs, {" ".join(depths)}'
+        lagcount = sum(lag.count for lag in lags)
+        if lagcount:
+            text += f', sheet lag {sum(lag.sum for lag in lags) / lagcount:.1f}s avg {max(lag.max for lag in lags):.1f}s max'
+        return text
+
+metrics = Metrics()
+metrics.counter('ongautobump_lines_total', 'Lines parsed')
+metrics.counter('ongautobump_events_total', 'Events parsed by type')
+metrics.histogram('ongautobump_parse_seconds', 'Time to classify and handle a line', PARSETIME)
+metrics.histogram('ongautobump_findnextrow_seconds', 'Time spent in findnextrow()', PARSETIME)
+metrics.counter('ongautobump_api_calls_total', 'Sheet API calls by method and outcome')
+metrics.histogram('ongautobump_api_seconds', 'Sheet API call latency by method')
+metrics.counter('ongautobump_backoffs_total', 'Backoffs after a failed sheet call by error code')
+metrics.histogram('ongautobump_backoff_seconds', 'Length of backoffs')
+metrics.histogram('ongautobump_flush_seconds', 'Time to write one batch to the sheet')
+metrics.counter('ongautobump_rows_written_total', 'Rows written to the sheet')
+metrics.counter('ongautobump_tail_probes_total', 'Column A reads made looking for the end of the sheet')
+metrics.counter('ongautobump_flushes_total', 'Flushes started by what made them due')
+metrics.counter('ongautobump_duplicate_songs_total', 'Song requests for a video already requested this stream')
+metrics.histogram('ongautobump_event_to_sheet_seconds', 'Time from reading a line to its row being in the sheet', LATENCY + (600,))
+
+
+class MeteredSheet(SheetBackend):
+    # Wraps a backend to time every API call
+    def __init__(self, sheet, name=""):
+        super().__init__()
+        self.sheet = sheet
+        self.name = name
+        self.calls = sheet.calls
+
+    def _timed(self, method, *args, **kwargs):
+        started = time.perf_counter()
+        outcome = 'ok'
+        try:
+            return getattr(self.sheet, method)(*args, **kwargs)
+        except Exception as e:
+            outcome = str(errorcode(e) or type(e).__name__)
+            raise
+        finally:
+            metrics.observe('ongautobump_api_seconds', time.perf_counter() - started, method=method, target=self.name)
+            metrics.inc('ongautobump_api_calls_total', method=method, outcome=outcome, target=self.name)
+
+    def get(self, range_name, pad_values=False):
+        return self._timed('get', range_name, pad_values=pad_values)
+
+    def batch_update(self, data, value_input_option=None):
+        return self._timed('batch_update', data, value_input_option=value_input_option)
+
+    @property
+    def row_count(self):
+        return self.sheet.row_count
+
+    def add_rows(self, rows):
+        return self._timed('add_rows', rows)
+
+    def reopen(self):
+        return self._timed('reopen')
+
+    def close(self):
+        self.sheet.close()
+
+    def __getattr__(self, name):
+        # Anything backend specific, like LocalSheet.gridrows
+        return getattr(self.sheet, name)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def servemetrics(host, port):
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    log.info(f'Serving metrics on http://{host}:{server.server_address[1]}/metrics')
+    return server
+
+def statsloop(interval):
+    while not inputdone.wait(interval):
+        log.info(metrics.summary())
+
+
+# Events
+#
+# A row on its way to the Support sheet.  The time, type and amount are
+# parsed once when the line comes in and the row is only turned back into
+# cells when it's written or spooled.  Anything that wouldn't come back out
+# exactly as it went in keeps its original text as well.
+class EventType(IntEnum):
+    NONE = 0      # STREAM START and END rows
+    TIP = 1
+    BITS = 2
+    SUB = 3
+    RAFFLE = 4
+    HYPE = 5
+    OTHER = 6     # anything else, the text is kept as it was
+
+typenames = {
+    EventType.NONE: '',
+    EventType.TIP: 'Tip',
+    EventType.BITS: 'Bits',
+    EventType.SUB: 'Sub',
+    EventType.RAFFLE: 'Raffle',
+    EventType.HYPE: 'Hype',
+}
+typesbyname = {name.casefold(): kind for kind, name in typenames.items()}
+amountpattern = re.compile(r'^\$?(-?)(\d+)(?:\.(\d\d))?$')
+
+def formatcents(cents):
+    if cents < 0:
+        return '-$%d.%02d' % divmod(-cents, 100)
+    return '$%d.%02d' % divmod(cents, 100)
+
+class Event:
+    __slots__ = ('when', 'order', 'gifter', 'member', 'kind', 'typetext', 'cents', 'amounttext', 'status', 'detail', 'key', 'id')
+
+    @classmethod
+    def fromcells(cls, cells):
+        if len(cells) != 8:
+            cells = list(cells[0:8]) + ['']*(8-len(cells))
+        row = cls.__new__(cls)
+
+        # Times are only ever compared and written back, so they stay text
+        row.when = str(cells[0])
+
+        # "Sub #12" is a Sub
+        text = str(cells[4])
+        kind = typesbyname.get(text.casefold())
+        if kind is None:
+            name = text.strip().casefold()
+            kind = typesbyname.get(name.split(' ')[0], EventType.OTHER) if name else EventType.NONE
+            row.typetext = text
+        else:
+            row.typetext = None if typenames[kind] == text else text
+        row.kind = kind
+
+        text = str(cells[5])
+        match = amountpattern.match(text.strip())
+        row.cents = None
+        row.amounttext = text or None
         if match:
-            video_id = match.group(1)
-            # If it's not already a full URL, convert simple ID to full URL
-            if not video_id.startswith('http'):
-                url_part = f'=HYPERLINK("https://youtu.be/{video_id}")'
-
-    title_part = '"' + parts[1].replace('"','').replace('(','').replace(')','') + '")'
-
-    # 2. Reconstruct
-    return f'{url_part}, {title_part}'
-
-def receiveline(line):
-    global row
-    global rowqueue
-    global hypequeue
-    global supportqueue
-    global songqueue
-    global detailupdate
-
-    # Valid date pattern
-    validdate = re.compile("^20[0-9][0-9]-[0-9][0-9]-[0-9][0-9]")
-    eventstring = re.compile(" ===")
-    hypeend = re.compile("=== HYPE TRAIN END")
-    hypelevel = re.compile(r'level=(\d*)')
-    streamstart = re.compile("=== ONLINE")
-    streamend = re.compile("=== OFFLINE")
-    songrequest = re.compile(r'SONG REQUEST FROM ([^:]+): (=HYPERLINK.*)')
-
+            negative, dollars, cents = match.groups()
+            row.cents = int(dollars)*100 + int(cents or 0)
+            if negative:
+                row.cents = -row.cents
+            # Only "$12.34" comes back the same from formatcents, so only
+            # that drops the original text
+            elif cents and text[0] == '$' and len(text) == len(dollars)+4 and (len(dollars) == 1 or dollars[0] != '0'):
+                row.amounttext = None
+
+        row.order = cells[1]
+        row.gifter = str(cells[2])
+        row.member = str(cells[3])
+        row.status = str(cells[6])
+        row.detail = str(cells[7])
+
+        # What makes two rows the same event: when, who, what and how much.
+        # None of these change once parsed, and they are plain values so the
+        # key can go through JSON and come back equal.
+        row.key = (row.when.strip(), row.gifter.strip(), row.member.strip(),
+                   kind if kind != EventType.OTHER else row.typetext.strip(),
+                   row.cents if row.cents is not None else text.strip())
+        row.id = None    # set once queued, the same line twice is two rows
+        return row
+
+    def copy(self):
+        row = Event.__new__(Event)
+        row.when = self.when
+        row.order = self.order
+        row.gifter = self.gifter
+        row.member = self.member
+        row.kind = self.kind
+        row.typetext = self.typetext
+        row.cents = self.cents
+        row.amounttext = self.amounttext
+        row.status = self.status
+        row.detail = self.detail
+        row.key = self.key
+        row.id = self.id
+        return row
+
+    def cells(self):
+        # The 8 sheet columns
+        if self.amounttext is not None:
+            amount = self.amounttext
+        else:
+            amount = formatcents(self.cents) if self.cents is not None else ''
+        return [self.when, self.order, self.gifter, self.member,
+                typenames[self.kind] if self.typetext is None else self.typetext, amount, self.status, self.detail]
+
+    def __repr__(self):
+        return repr(self.cells())
+
+
+# Line classification
+#
+# Every line is sorted into one of these in a single pass with patterns
+# compiled once, then handed to the matching receive function.
+class SupportLine(NamedTuple):
+    row: Event            # the 8 sheet columns, parsed
+
+class HypeLine(NamedTuple):
+    when: str
+    level: Optional[int]  # level reached, None if the line didn't say
+
+class StreamStartLine(NamedTuple):
+    when: str
+
+class StreamEndLine(NamedTuple):
+    when: str
+
+class SongRequestLine(NamedTuple):
+    requester: str
+    payload: str          # the =HYPERLINK(...) as written
+
+class UnknownLine(NamedTuple):
+    line: str
+
+validdate = re.compile("^20[0-9][0-9]-[0-9][0-9]-[0-9][0-9]")
+eventmarker = re.compile("=== (HYPE TRAIN END|ONLINE|OFFLINE)")
+hypelevel = re.compile(r'level=(\d*)')
+songrequest = re.compile(r'SONG REQUEST FROM ([^:]+): (=HYPERLINK.*)')
+
+def classifyline(line):
+    # Returns None for lines that are deliberately ignored
     items = line.split("\t")
     if len(items) > 1 and validdate.match(items[0]):
-        if not eventstring.match(items[1]):
-            print(f'Adding Entry: {line.rstrip()}', flush=True)
-            # Make sure its the right length
-            if len(items)>7:
-                items[7] = ''
-            else:
-                while len(items)<8:
-                    items.append('')
-            rowqueue.append(items[0:8])
-
-            # This builds a map of support by member
-            if (items[4] in ["Tip", "Bits", "Raffle"]) and ( float(items[5].replace('$','')) >= 10 or items[5] == "$0.00" ):
-                supportqueue.append([items[3],len(rowqueue)-1+row,items[5]])
-
-    elif hypeend.search(line):
-        hypelevel = hypelevel.search(line)
-        print(f'Hype: {hypelevel.group(1)}', flush=True)
-        if hypelevel.group(1):
-            level = int(hypelevel.group(1)) -1
-            # New way to record Hype Trains Directly
-            items = line.split(" ")
-            rowqueue.append([items[0]+" "+items[1],"","","Hype Train End","Hype","0.00","na", f'Completed Level {level}'])
+        if items[1].startswith(" ==="):
+            return None
+        # Make sure its the right length
+        if len(items)>7:
+            items[7] = ''
+        else:
+            while len(items)<8:
+                items.append('')
+        return SupportLine(Event.fromcells(items))
+
+    marker = eventmarker.search(line)
+    if marker:
+        kind = marker.group(1)
+        if kind == "HYPE TRAIN END":
+            level = hypelevel.search(line)
+            words = line.split(" ")
+            return HypeLine(words[0]+" "+words[1], int(level.group(1)) if level and level.group(1) else None)
+        when = line.split(" === ")[0]
+        if kind == "ONLINE":
+            return StreamStartLine(when)
+        return StreamEndLine(when)
+
+    song = songrequest.search(line)
+    if song:
+        return SongRequestLine(song.group(1), song.group(2))
+
+    return UnknownLine(line)
+
+
+# Song links
+#
+# Requests come in as =HYPERLINK("link", "title") with the link in any of
+# the shapes people paste: youtu.be and youtube.com links with tracking and
+# playlist parameters, watch?v=, shorts, a bare video id or just "v=id".
+# YouTube links all come out as https://youtu.be/ID (keeping a start time),
+# so the same song is the same link whoever asked for it.  Anything else,
+# including bare text that isn't an 11 character id, is kept as it was typed;
+# turning "abc" into youtu.be/abc would only make a dead link look real.
+# Titles lose their quotes and brackets like they always have, so the
+# formula can't break.  The same payload is seen once per target and often
+# more than once a stream, so results are cached on it.
+class SongLink(NamedTuple):
+    videoid: Optional[str]   # YouTube video id, None for other links
+    url: str
+    title: str
+
+    def formula(self):
+        return f'=HYPERLINK("{self.url}", "{self.title}")'
+
+hyperlink = re.compile(r'^\s*=HYPERLINK\(\s*"([^"]*)"\s*(?:[,;]\s*(.*?))?\s*\)?\s*$', re.DOTALL)
+videoid = re.compile(r'^[A-Za-z0-9_-]{11}$')
+youtubehosts = ('youtube.com', 'www.youtube.com', 'm.youtube.com', 'music.youtube.com', 'youtube-nocookie.com', 'www.youtube-nocookie.com')
+youtubepaths = ('shorts', 'embed', 'live', 'v', 'e')
+titlejunk = re.compile(r'["()]')
+spaces = re.compile(r'\s+')
+
+def youtubeid(link):
+    # The video id from anything that looks like a YouTube link, and the
+    # start time if it had one
+    if videoid.match(link):
+        return link, None
+    if not link.startswith(('http://', 'https://')):
+        link = 'https://' + link if '/' in link.split('?')[0] and '.' in link.split('/')[0] else 'https://youtu.be/' + link
+    try:
+        parts = urlsplit(link)
+    except ValueError:
+        return None, None
+    query = parse_qs(parts.query)
+    path = [part for part in parts.path.split('/') if part]
+    found = None
+    host = parts.netloc.lower().split(':')[0]
+    if host == 'youtu.be' and path:
+        found = path[0]
+    elif host in youtubehosts:
+        if query.get('v'):
+            found = query['v'][0]
+        elif len(path) >= 2 and path[0] in youtubepaths:
+            found = path[1]
+    if found is not None and found.startswith('v='):
+        found = found[2:]    # youtu.be/v=ID
+    if found is None or not videoid.match(found):
+        return None, None
+    start = query.get('t', query.get('start', [None]))[0]
+    return found, start
+
+@functools.lru_cache(maxsize=1024)
+def parsesonglink(payload):
+    # SongLink from a =HYPERLINK(...) payload, None if it isn't one
+    match = hyperlink.match(payload)
+    if not match:
+        return None
+    link = match.group(1).strip()
+    title = spaces.sub(' ', titlejunk.sub('', match.group(2) or '')).strip()
+
+    found, start = youtubeid(link)
+    if found is None:
+        return SongLink(None, link, title)
+    url = f'https://youtu.be/{found}'
+    if start is not None and re.match(r'^\w+$', start):
+        url += f'?t={start}'
+    return SongLink(found, url, title)
 
-            # Old way.  If nothing adds to the queue, it will not do anything.  Later to remove this code.
-            # hypequeue.append([[[ f'Hypetrain Completed Level {level}']],row+len(rowqueue)-1])
-    elif streamstart.search(line):
-        items = line.split(" === ")
-        print(f'Stream Start: {items[0]}', flush=True)
-        rowqueue.append([items[0],"","","STREAM START","","","",""])
-        supportqueue=[]    # Erase the support queue
-        songqueue=[]    # Erase the song queue
-    elif streamend.search(line):
-        items = line.split(" === ")
-        print(f'Stream End: {items[0]}', flush=True)
-        rowqueue.append([items[0],"","","STREAM END","","","",""])
-        supportqueue=[]    # Erase the support queue
-        songqueue=[]    # Erase the song queue
-    elif songrequest.search(line):
-        songdetail = songrequest.search(line)
-        requester = songdetail.group(1)
-        song = remove_inside_quotes(songdetail.group(2))
-        print(f'Song Request from {requester}: {song}', flush=True)
-        
-        # Search through supportqueue for a matching member
-        detailupdate = []  # Array to hold updates for non-existing entries
-        
-        # Iterate through supportqueue backwards to avoid index shifting issues when removing items
-        i = len(supportqueue) - 1
-        match_found = False
-        while i >= 0:
-            (member, row_num, amount) = supportqueue[i]
-            
-            # Check if this is the matching requester
-            if member.lower() == requester.lower():
-                # Look for existing entry in rowqueue with same member and amount
-                found_existing = False
-                for j, row_entry in enumerate(rowqueue):
-                    if (row_entry[3] == member and 
-                        row_entry[5] == amount and 
-                        row_entry[4] in ["Tip", "Bits", "Raffle"]):
-                        
-                        # Update the existing entry with song detail
-                        row_entry[7] = f'{song}'
-                        found_existing = True
-                        break
-                
-                if not found_existing:
-                    # Add to detailupdate array for later processing
-                    detailupdate.append([row_num, requester, song])
-                
-                # Remove from supportqueue
-                supportqueue.pop(i)
-
-                match_found = True
-                break  # Don't continue to next item in queue as we've found a match for this request
-            
-            i -= 1
-        
-        if not match_found:
-            songqueue.append([requester, song, False])
-            print(f'No match found for {requester}\'s request. Added to songqueue')
-
-        # Process detailupdate array - this would be handled in the main function when updating the sheet
+def remove_inside_quotes(input_string):
+    # The request as it goes in the sheet
+    link = parsesonglink(input_string)
+    if link is None:
+        log.warning(f'Unexpected input: {input_string} - Skipping. Expected format: =HYPERLINK("url", "title")')
+        return input_string # Return original if format is unexpected
+    return link.formula()
+
+# Song requests are matched to the support that paid for them.  Qualifying
+# support waits here by case-folded member until that member's request comes
+# in, and requests that come in first wait for the support, so either way
+# round it's a dictionary lookup.  Both sides are forgotten when a stream
+# starts or ends, or after expiry seconds if that's set; expired songs are
+# handed back so they come out of the notes as well.
+class SongMatcher:
+    def __init__(self, expiry=0.0, spool=None):
+        self.expiry = expiry
+        self.spool = spool    # every entry added or taken is written through to it
+        self.supports = {}    # member -> [[member, row, amount, row id, added, id], ...] newest last
+        self.byid = {}        # queued row id -> support entry, to correct its row once written
+        self.songs = {}       # member -> deque of (songqueue entry, added, id), oldest first
+        self.lastid = 0
+
+    def expired(self, added, now):
+        return self.expiry > 0 and now - added > self.expiry
+
+    def newid(self):
+        self.lastid += 1
+        return self.lastid
+
+    def saved(self, kind, entryid, value=None):
+        # Written through to the spool, or removed from it without a value
+        if self.spool is not None:
+            if value is None:
+                self.spool.remove(kind, entryid)
+            else:
+                self.spool.put(kind, entryid, value)
+
+    def addsupport(self, member, row_num, amount, rowid, now=None):
+        # rowid is None for support already in the sheet at row_num
+        if now is None:
+            now = time.time()
+        entry = [member, row_num, amount, rowid, now, self.newid()]
+        self.supports.setdefault(member.casefold(), []).append(entry)
+        if rowid is not None:
+            self.byid[rowid] = entry
+        self.saved('support', entry[5], entry)
+
+    def takesupport(self, member, now=None):
+        # Most recent support from member, or None
+        if now is None:
+            now = time.time()
+        waiting = self.supports.get(member.casefold())
+        if not waiting:
+            return None
+        entry = waiting.pop()
+        self.byid.pop(entry[3], None)
+        self.saved('support', entry[5])
+        if self.expired(entry[4], now):
+            # Everything older has expired too
+            for old in waiting:
+                self.byid.pop(old[3], None)
+                self.saved('support', old[5])
+            waiting.clear()
+            return None
+        return entry
+
+    def addsong(self, entry, now=None):
+        added = now if now is not None else time.time()
+        songid = self.newid()
+        self.songs.setdefault(entry[0].casefold(), deque()).append((entry, added, songid))
+        self.saved('song', songid, [entry, added])
+
+    def takesong(self, member, now=None):
+        # Oldest song member asked for that is still waiting, or None, and
+        # the songs that expired on the way to it
+        if now is None:
+            now = time.time()
+        waiting = self.songs.get(member.casefold())
+        expired = []
+        while waiting:
+            entry, added, songid = waiting.popleft()
+            self.saved('song', songid)
+            if not self.expired(added, now):
+                return entry, expired
+            expired.append(entry)
+        return None, expired
+
+    def expire(self, now=None):
+        # Forget everything that has waited too long, returns the songs
+        if now is None:
+            now = time.time()
+        expired = []
+        for waiting in self.songs.values():
+            while waiting and self.expired(waiting[0][1], now):
+                entry, added, songid = waiting.popleft()
+                self.saved('song', songid)
+                expired.append(entry)
+        for waiting in self.supports.values():
+            while waiting and self.expired(waiting[0][4], now):
+                entry = waiting.pop(0)
+                self.byid.pop(entry[3], None)
+                self.saved('support', entry[5])
+        return expired
+
+    def placed(self, rowid, row_num):
+        # The row predicted when the support came in can be off once
+        # duplicates are dropped, so use where it actually went
+        entry = self.byid.pop(rowid, None)
+        if entry is not None:
+            entry[1] = row_num
+            entry[3] = None
+            self.saved('support', entry[5], entry)
+
+    def __len__(self):
+        return sum(len(waiting) for waiting in self.supports.values())
+
+    def clear(self):
+        self.supports.clear()
+        self.byid.clear()
+        self.songs.clear()
+        if self.spool is not None:
+            self.spool.removeall('support')
+            self.spool.removeall('song')
+
+    def load(self):
+        # Back from the spool, returns the songs still waiting oldest first
+        self.supports.clear()
+        self.byid.clear()
+        self.songs.clear()
+        for name, entry in sorted(self.spool.items('support'), key=lambda item: item[1][4]):
+            self.supports.setdefault(entry[0].casefold(), []).append(entry)
+            if entry[3] is not None:
+                self.byid[entry[3]] = entry
+            self.lastid = max(self.lastid, entry[5])
+        songs = []
+        for name, (entry, added) in sorted(self.spool.items('song'), key=lambda item: item[1][1]):
+            self.songs.setdefault(entry[0].casefold(), deque()).append((entry, added, int(name)))
+            self.lastid = max(self.lastid, int(name))
+            songs.append(entry)
+        return songs
+
+songsupport = (EventType.TIP, EventType.BITS, EventType.RAFFLE)    # what can pay for a song
+
+# Running totals for the stream, written into the Detail column of the
+# STREAM END row so nobody needs formulas over the whole sheet for them.
+# Everything is added up as rows are queued, and only picking out the top
+# supporters looks at more than one entry, once a stream.  Rows already in
+# the sheet (a restart replaying the log) aren't counted again.
+class StreamTotals:
+    def __init__(self, top=3, spool=None):
+        self.top = top
+        self.spool = None
+        self.clear()
+        self.spool = spool    # each total is written through to it as it changes
+
+    def clear(self):
+        self.cents = Counter()         # type -> cents
+        self.counts = Counter()        # type -> rows
+        self.supporters = Counter()    # gifter, or member if there isn't one -> cents
+        self.requested = 0             # song requests
+        self.matched = 0               # song requests that found their support
+        self.hypetrains = 0
+        self.hypelevel = 0             # highest level completed
+        if self.spool is not None:
+            self.spool.removeall('totals')
+
+    def saved(self, field, name=None):
+        if self.spool is not None:
+            value = getattr(self, field) if name is None else getattr(self, field)[name]
+            self.spool.put('totals', json.dumps([field, name]), value)
+
+    def add(self, row):
+        if row.kind == EventType.NONE or row.kind == EventType.HYPE:
+            return
+        name = typenames.get(row.kind) or row.typetext.strip()
+        self.counts[name] += 1
+        self.saved('counts', name)
+        if row.cents is not None and row.cents > 0:
+            supporter = (row.gifter or row.member).strip()
+            self.cents[name] += row.cents
+            self.supporters[supporter] += row.cents
+            self.saved('cents', name)
+            self.saved('supporters', supporter)
+
+    def addrequest(self):
+        self.requested += 1
+        self.saved('requested')
+
+    def addmatch(self):
+        self.matched += 1
+        self.saved('matched')
+
+    def hype(self, level):
+        self.hypetrains += 1
+        self.hypelevel = max(self.hypelevel, level)
+        self.saved('hypetrains')
+        self.saved('hypelevel')
+
+    def empty(self):
+        return not self.counts and not self.requested and not self.hypetrains
+
+    def summary(self):
+        # "Tip $532.13 (9), Sub $70.00 (14) | Top: ... | Songs: 14 requested, 7 matched | Hype trains: 1, level 3"
+        parts = [', '.join(f'{name} {formatcents(self.cents[name])} ({count})' if self.cents[name] else f'{name} ({count})'
+                           for name, count in sorted(self.counts.items(), key=lambda item: (-self.cents[item[0]], item[0])))]
+        if self.supporters:
+            parts.append('Top: ' + ', '.join(f'{name} {formatcents(cents)}' for name, cents in self.supporters.most_common(self.top)))
+        if self.requested:
+            parts.append(f'Songs: {self.requested} requested, {self.matched} matched')
+        if self.hypetrains:
+            parts.append(f'Hype trains: {self.hypetrains}, level {self.hypelevel}')
+        return ' | '.join(part for part in parts if part)
+
+    def load(self):
+        spool, self.spool = self.spool, None
+        self.clear()
+        self.spool = spool
+        for name, value in spool.items('totals'):
+            field, key = json.loads(name)
+            if key is None:
+                setattr(self, field, value)
+            else:
+                getattr(self, field)[key] = value
+
+eventtypes = {
+    HypeLine: 'hype',
+    StreamStartLine: 'stream_start',
+    StreamEndLine: 'stream_end',
+    SongRequestLine: 'song_request',
+    UnknownLine: 'unknown',
+}
+
+# Dates come back from the sheet without leading zeros and some reason spaces
+# get turned into \xa0, so rows read from the sheet are normalized to match
+# the input data before comparing.
+sheetdate = re.compile(r'^(\d+)-(\d+)-(\d+)\s(\d+):(\d+):(\d+)')
+oddspace = re.compile(r'[^\S ]')    # whitespace that isn't a plain space
+
+def normalizecells(datarow):
+    cells = [oddspace.sub(' ', cell) for cell in datarow]
+    dateraw = sheetdate.match(cells[0]) if cells else None
+    if dateraw:
+        datenew = [value.rjust(2, '0') for value in dateraw.groups()]
+        cells[0] = f'{datenew[0]}-{datenew[1]}-{datenew[2]} {datenew[3]}:{datenew[4]}:{datenew[5]}'
+    return cells
+
+def eventkey(row):
+    # Event.key, for rows read back from the sheet as cells too
+    if not isinstance(row, Event):
+        row = Event.fromcells(row)
+    return row.key
+
+# Finding the end of the sheet
+#
+# The first blank row is found from A-D, one row per probe, and a row with
+# anything in A, C or D is used (one typed in by hand may have no date).
+# Step forward (or back) from the row we expected in doubling steps until
+# a blank row is passed, then halve back down to it.  A stale statefile
+# costs a couple of extra probes rather than reading every row in between,
+# and nothing past the grid size in the worksheet metadata is ever read.
+def locatetail(sheet, hint):
+    # Returns (first blank row, probes made)
+    lastrow = sheet.row_count
+    probes = 0
+
+    def used(rownum):
+        nonlocal probes
+        if rownum < 2:
+            return True     # the header
+        if rownum > lastrow:
+            return False
+        probes += 1
+        data = sheet.get(f'A{rownum}:D{rownum}')
+        cells = data[0] if data else []
+        return any(str(cells[col]).strip() for col in (0, 2, 3) if col < len(cells))
+
+    hint = min(max(2, hint), lastrow+1)
+    step = 1
+    if used(hint):
+        low, high = hint, None
+        while high is None:
+            if used(low+step):
+                low += step
+                step *= 2
+            else:
+                high = low+step
     else:
-        print(f'Did not understand: {line}')
-    
-def findnextrow():
-    global supportSheet
-    global row
-    global lastrow
-    global rowqueue
-    global hypequeue
-    global newrowcount
-    global newrowused
-    global rowsearchwidth
-
-    validdate = re.compile(r'^(\d+)-(\d+)-(\d+)\s(\d+):(\d+):(\d+)')
-
-    # Expand size of the search window based on input size
-    if len(rowqueue) > rowsearchwidth:
-        rowsearchwidth=len(rowqueue)*4
-
-    count = rowsearchwidth + 1
-    startrow = row - rowsearchwidth
-    if startrow < 2:
-        startrow = 2
-    blankfound = False
-    while not blankfound:
-        endrow = row + rowsearchwidth
-        print(f'Looking for last row between {startrow} and {endrow}')
-        count = 0
-        rowpos = startrow
+        low, high = None, hint
+        while low is None:
+            if used(high-step):
+                low = high-step
+            else:
+                high -= step
+                step *= 2
+            step = min(step, high-1)
+
+    # low is used and high is blank, nothing in between is known
+    while high - low > 1:
+        middle = (low + high) // 2
+        if used(middle):
+            low = middle
+        else:
+            high = middle
+    return high, probes
+
+# Local copy of the bottom of the Support sheet
+#
+# The tail is read once at startup and then kept up to date from our own
+# appends, so a flush doesn't have to read the sheet again.  Every ttl
+# seconds a small read of the last couple of rows checks that nobody has
+# edited the bottom of the sheet by hand, and only if they have is the whole
+# window read again.
+class SheetMirror:
+    def __init__(self, size=200, ttl=60.0):
+        self.size = size
+        self.ttl = ttl
+        self.rows = deque()    # (row number, normalized A-G cells)
+        self.keys = Counter()  # eventkey() of each row in self.rows
+        self.nextrow = None    # None until the tail has been read
+        self.checked = 0.0
+
+    def seed(self, rows, nextrow):
+        self.rows = deque()
+        self.keys = Counter()
+        self._extend(rows)
+        self.nextrow = nextrow
+        self.checked = time.monotonic()
+
+    def add(self, firstrow, rows):
+        self._extend((firstrow+i, normalizecells([str(cell) for cell in row.cells()[0:7]])) for i, row in enumerate(rows))
+        self.nextrow = firstrow + len(rows)
+
+    def _extend(self, rows):
+        for rownum, cells in rows:
+            if len(self.rows) == self.size:
+                oldnum, oldcells = self.rows.popleft()
+                oldkey = eventkey(oldcells)
+                self.keys[oldkey] -= 1
+                if self.keys[oldkey] <= 0:
+                    del self.keys[oldkey]
+            while len(cells) < 6:
+                cells.append('')
+            self.rows.append((rownum, cells))
+            if cells[0] != "":
+                self.keys[eventkey(cells)] += 1
+
+    def lastorder(self):
+        # Order of the last row that has one
+        for rownum, cells in reversed(self.rows):
+            if cells[0] != "" and re.match(r'^-?\d+$', cells[1]):
+                return int(cells[1])
+        return None
+
+    def rowof(self, key):
+        # Where a row already in the sheet is, None if it's not in the mirror
+        for rownum, cells in reversed(self.rows):
+            if cells[0] != "" and eventkey(cells) == key:
+                return rownum
+        return None
+
+    def invalidate(self):
+        self.nextrow = None
+
+    def expire(self):
+        # Still a good guess, but check it against the sheet before trusting it
+        self.checked = float('-inf')
+
+    def expired(self):
+        return time.monotonic() - self.checked > self.ttl
+
+    def check(self, sheet):
+        # The last two rows should be what we wrote and the next one blank
+        startrow = max(2, self.nextrow - 2)
+        known = {rownum: cells[0:4] for rownum, cells in self.rows}
         try:
-            data = supportSheet.get(f'A{startrow}:G{endrow}', pad_values=True)
-            print(f'Data received: {len(data)}', flush=True)
+            data = sheet.get(f'A{startrow}:D{self.nextrow}', pad_values=True)
         except Exception as e:
-            exc_type, exc_obj, exc_tb = sys.exc_info()
-            fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-            print(exc_type, fname, exc_tb.tb_lineno)
-            print(traceback.format_exc())
-            sys.exit(f"Google Sheet Exception {e}")
-
-        for datarow in data:
-            newrow = []
-            # Some reason spaces get turned into \xa0.
-            for cell in datarow:
-                cell = re.sub(r'\s',' ',cell)
-                newrow.append(cell)
-            count += 1
-            rowpos += 1
-            # Check to see if row is blank
-            #print(f'{row} {newrow[0]}')
-            if newrow[0] != "":
-                if rowpos > row:
-                    row = rowpos
-                # Worse we need to normalize the date string for leading zeros to match input data
-                dateraw = validdate.match(newrow[0])
-                if dateraw and len(rowqueue)>0:
-                    datenew=[]
-                    for i in range(6):
-                        value = dateraw.group(i+1)
-                        if int(value)<10 and len(value) == 1:
-                            value=f'0{value}'
-                        datenew.append(value)
-                    datestring=f'{datenew[0]}-{datenew[1]}-{datenew[2]} {datenew[3]}:{datenew[4]}:{datenew[5]}'
-                    #print(f'date: {int(datenew[3])} {datenew[3][0]} {datestring}')
-
-                    # Display the rows that were found
-                    #print(f' In Sheet: {row} {newrow}')
-
-                    # Use the date string and C/D column to eliminate duplicates
-                    newrowqueue = []
-                    if newrow[1] != "":
-                        ordercount = int(newrow[1])
-
-                    #print(f'Checking against {newrow}')
-                    for r in range(0,len(rowqueue)):
-                        #print(f' Datestring: {datestring} rowqueue: {rowqueue[r][0]}')
-                        if datestring == rowqueue[r][0] and (newrow[3] == "STREAM START" or (newrow[2] == rowqueue[r][2] and newrow[3] == rowqueue[r][3] and newrow[4][:3] == rowqueue[r][4][:3] and newrow[5] == rowqueue[r][5])):
-                            print(f'  Already in sheet: ${rowqueue[r]}')
-                            # Decrease and hype count row by one
-                            for i in range(len(hypequeue)):
-                                hypequeue[i][1]-=1
-                        else:
-                            newrowqueue.append(rowqueue[r])
-                    rowqueue = newrowqueue
-            
-            # Blank row found
-            if newrow[0] == "" and newrow[2] == "" and newrow[3] == "" and not blankfound:
-                row = rowpos
-                blankfound = True
-                print(f'Found last blank row {row}', flush=True)
-
-        if not blankfound:    
-            row = rowpos
-            print(f'Found last row {row}', flush=True)
-            blankfound = True
-        startrow = row - 5
-        if startrow < 2:
-            startrow = 2
-        rowsearchwidth = 10 # Reduce future search width
-
-    # Find the last row not likely to have anything in the comment field
-    if len(rowqueue)>0:
-        for r in range(0,len(rowqueue)):
-            # Generate the order column, if STREAM START, then ordercount is an offset from r+1
-            if rowqueue[r][3] == "STREAM START" or rowqueue[r][3] == "STREAM END":
-                ordercount=(-r-1)
-            rowqueue[r][1]= r+ordercount+1
-            if rowqueue[r][5]:
-                dollarvalue = float(re.sub(r'\$','',rowqueue[r][5]))
-                if dollarvalue < 24.99:
-                    lastrow = row + r
-
-    print(f'Next blank row: {row} New rows to add: {len(rowqueue)}')
-
-    print(f'To Add:')
-    for r in range(0,len(rowqueue)):
-        print(f'{rowqueue[r]}')
-
-
-def main() -> int:
-    global row
-    global rowqueue
-    global hypequeue
-    global supportSheet
-    global detailupdate
-    global songqueue
-
-    args = parse_args()
-
-    gc = gspread.service_account(filename=args.gsheets_credentials_file)
-    print(gc)
-
-    if args.gsheets_id is None:
-        ONG_BUMP_SPREADSHEET_ID = "19zRJ-EIBsJr37l8HViPpGjEJvotfzzkFIKeyxLz6WYg"
-    else:
-        ONG_BUMP_SPREADSHEET_ID = args.gsheets_id
-
-    ONG_BUMP_SPREADSHEET_URL = f"https://docs.google.com/spreadsheets/d/{ONG_BUMP_SPREADSHEET_ID}"
- 
-    print(f"Using Sheet: {ONG_BUMP_SPREADSHEET_URL}")
-    # gsheet = gc.open("Test Copy of JonathanOng Bump Log")
-    gsheet = gc.open_by_key(ONG_BUMP_SPREADSHEET_ID)
-    supportSheet= gsheet.worksheet("Support")
-
-    # sys.exit()
-    state_path = Path(__file__).resolve().parent / args.statefile
-
-    if args.line is not None:
-        row = args.line
-        state_path.write_text(str(row))
-
-    row = int(state_path.read_text())
-    
-    print("Ready for data...", flush=True)
-    # Ok take stdin and enter into bump log 
-    failure_count=0
-    
+            log.warning(f'Could not check the end of the sheet: {e}')
+            return False
+        for i in range(self.nextrow - startrow + 1):
+            rownum = startrow + i
+            cells = normalizecells(data[i])[0:4] if i < len(data) else []
+            cells += ['']*(4-len(cells))
+            expected = known.get(rownum, ['']*4) if rownum < self.nextrow else ['']*4
+            if [cell.strip() for cell in cells] != [cell.strip() for cell in expected]:
+                log.warning(f'Sheet changed at row {rownum}: {cells} expected {expected}')
+                self.invalidate()
+                return False
+        self.checked = time.monotonic()
+        return True
+
+# Write coalescing
+#
+# Everything a tick has to write (new rows, songs for rows already in the
+# sheet, the list of queued songs under the last row and hype notes) is
+# gathered up and sent as a single values batch update.
+class WriteCoalescer:
+    def __init__(self):
+        self.data = []
+        self.stats = Counter()    # requests, ranges, cells and rows written
+
+    def rows(self, firstrow, rows):
+        self.data.append({'range': f'A{firstrow}:{rowcol_to_a1(firstrow+len(rows)-1, 8)}', 'values': [row.cells() for row in rows]})
+        self.stats['rows'] += len(rows)
+
+    def column(self, firstrow, col, values):
+        label = rowcol_to_a1(firstrow, col)
+        if len(values) > 1:
+            label += ':' + rowcol_to_a1(firstrow+len(values)-1, col)
+        self.data.append({'range': label, 'values': [[value] for value in values]})
+
+    def cell(self, rownum, col, value):
+        self.column(rownum, col, [value])
+
+    def lastrow(self):
+        last = 0
+        for update in self.data:
+            rownum, col = a1_to_rowcol(update['range'].split(':')[0])
+            last = max(last, rownum + len(update['values']) - 1)
+        return last
+
+    def flush(self, sheet):
+        if len(self.data) == 0:
+            return None
+
+        # Writes can't go off the end of the grid, so grow it first when needed
+        if self.lastrow() > sheet.row_count:
+            sheet.add_rows(max(self.lastrow() - sheet.row_count, newrowcount))
+            self.stats['add_rows'] += 1
+
+        cells = sum(len(update['values'][0])*len(update['values']) for update in self.data)
+        result = sheet.batch_update(self.data, value_input_option='USER_ENTERED')
+        self.stats['requests'] += 1
+        self.stats['ranges'] += len(self.data)
+        self.stats['cells'] += cells
+        log.info(f'Wrote {len(self.data)} ranges, {cells} cells in one request '
+                 f'(total {self.stats["requests"]} requests for {self.stats["ranges"]} ranges)')
+        self.data = []
+        return result
+
+    def discard(self):
+        self.data = []
+
+
+# Write-ahead spool
+#
+# Every line read and every row queued is recorded in a small SQLite
+# database alongside the state file, along with the song/support queues and
+# the row cursor.  After a crash or restart the pending rows, queues and the
+# end of the sheet as we last wrote it all come back from here, so nothing
+# is lost and neither the sheet nor the log needs to be read again.  What
+# grows over a stream (support and songs waiting to be matched, videos asked
+# for, the totals) is kept one entry per row in items, so a line only
+# writes the entries it changed.
+class Spool:
+    def __init__(self, path, keeplines=1000, keeprows=200):
+        self.path = path
+        self.keeplines = keeplines
+        self.keeprows = keeprows
+        # Shared between the reader and writer, always used under the session's lock
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS lines (id INTEGER PRIMARY KEY, line TEXT, received REAL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY, key TEXT, items TEXT, state TEXT, row INTEGER)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS events_state ON events (state)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS items (kind TEXT, name TEXT, value TEXT, PRIMARY KEY (kind, name))')
+        self.db.commit()
+
+    def line(self, line):
+        self.db.execute('INSERT INTO lines (line, received) VALUES (?, ?)', (line, time.time()))
+
+    def queued(self, row):
+        # Returns the id the row is known by from now on
+        return self.db.execute("INSERT INTO events (key, items, state) VALUES (?, ?, 'pending')", (json.dumps(row.key), json.dumps(row.cells()))).lastrowid
+
+    def updated(self, row):
+        # A pending row was changed in place (a song attached to it)
+        self.db.execute("UPDATE events SET items = ? WHERE id = ?", (json.dumps(row.cells()), row.id))
+
+    def sent(self, firstrow, rows):
+        for i, row in enumerate(rows):
+            self.db.execute("UPDATE events SET items = ?, state = 'sent', row = ? WHERE id = ?", (json.dumps(row.cells()), firstrow+i, row.id))
+
+    def dropped(self, rows):
+        # Found to be in the sheet already
+        for row in rows:
+            self.db.execute("UPDATE events SET state = 'dropped' WHERE id = ?", (row.id,))
+
+    def save(self, name, value):
+        self.db.execute('INSERT OR REPLACE INTO state (name, value) VALUES (?, ?)', (name, json.dumps(value)))
+
+    def load(self, name, default=None):
+        result = self.db.execute('SELECT value FROM state WHERE name = ?', (name,)).fetchone()
+        if result is None:
+            return default
+        return json.loads(result[0])
+
+    def put(self, kind, name, value):
+        self.db.execute('INSERT OR REPLACE INTO items (kind, name, value) VALUES (?, ?, ?)', (kind, str(name), json.dumps(value)))
+
+    def remove(self, kind, name):
+        self.db.execute('DELETE FROM items WHERE kind = ? AND name = ?', (kind, str(name)))
+
+    def removeall(self, kind):
+        self.db.execute('DELETE FROM items WHERE kind = ?', (kind,))
+
+    def items(self, kind):
+        return [(name, json.loads(value)) for (name, value) in self.db.execute('SELECT name, value FROM items WHERE kind = ?', (kind,))]
+
+    def pending(self):
+        rows = []
+        for rowid, items in self.db.execute("SELECT id, items FROM events WHERE state = 'pending' ORDER BY id"):
+            row = Event.fromcells(json.loads(items))
+            row.id = rowid
+            rows.append(row)
+        return rows
+
+    def tail(self):
+        # The last rows we wrote, oldest first
+        rows = self.db.execute("SELECT row, items FROM events WHERE state = 'sent' ORDER BY row DESC LIMIT ?", (self.keeprows,)).fetchall()
+        return [(rownum, json.loads(items)) for (rownum, items) in reversed(rows)]
+
+    def recentlines(self):
+        return Counter(line for (line,) in self.db.execute('SELECT line FROM lines ORDER BY id DESC LIMIT ?', (self.keeplines,)))
+
+    def prune(self):
+        self.db.execute('DELETE FROM lines WHERE id <= (SELECT MAX(id) FROM lines) - ?', (self.keeplines,))
+        self.db.execute("DELETE FROM events WHERE state != 'pending' AND id NOT IN (SELECT id FROM events WHERE state = 'sent' ORDER BY row DESC LIMIT ?)", (self.keeprows,))
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+# Reading and writing pipeline
+#
+# A reader thread does nothing but pull lines off stdin (or the followed
+# log) into a bounded queue, the main thread parses them and hands each
+# event to every session, and each session has a writer thread flushing
+# what it has queued to its sheet.  Sheet I/O never holds a session's lock,
+# so a slow write or a backoff doesn't stop lines being read and parsed.  If
+# a writer falls far enough behind that the line queue fills up, the reader
+# stops reading and the pipe from tail backs up.
+inputdone = threading.Event()   # stdin has hit EOF (a followed log never does)
+linequeue = queue.Queue()
+linelag = 0.0                   # how long the last line waited to be parsed
+linearrived = None              # when the line being parsed was read
+sessions = []                   # one per sheet being written to
+readyafter = 0.0                # seconds from starting to reading lines
+
+def sessiongauge(count):
+    return lambda: {session.name: count(session) for session in sessions}
+
+metrics.gauge('ongautobump_startup_seconds', 'Seconds from starting to being ready for data', lambda: readyafter)
+metrics.gauge('ongautobump_lines_waiting', 'Lines read but not parsed yet', lambda: linequeue.qsize())
+metrics.gauge('ongautobump_rows_pending', 'Rows waiting to be written', sessiongauge(lambda session: len(session.rowqueue)))
+metrics.gauge('ongautobump_rows_inflight', 'Rows being written', sessiongauge(lambda session: len(session.inflight)))
+metrics.gauge('ongautobump_songs_waiting', 'Song requests waiting for support', sessiongauge(lambda session: len(session.songqueue)))
+metrics.gauge('ongautobump_supports_waiting', 'Support waiting for a song request', sessiongauge(lambda session: len(session.matcher)))
+metrics.gauge('ongautobump_details_pending', 'Song details waiting to be written to rows already in the sheet', sessiongauge(lambda session: len(session.detailupdate)))
+
+def handover(lines, item, full):
+    # Put a line on the input queue.  Saying so every line while the sheet
+    # holds things up would bury the log, so this warns once when the queue
+    # fills and once when it is back down to half, and returns whether it
+    # is still counted as full.
+    if lines.full():
+        if not full:
+            log.warning(f'Input queue full, waiting for the sheet to catch up: {showstats()}')
+        full = True
+    elif full and lines.qsize() <= lines.maxsize // 2:
+        log.info(f'Input queue caught up: {showstats()}')
+        full = False
+    lines.put(item)
+    return full
+
+def readlines(stream, lines):
+    full = False
     while True:
         try:
-            # Check for up to a second for more data
-            while select.select([sys.stdin],[],[],1.0)[0]:
-                print('Reading Line: ', end='', flush=True)
-                line = sys.stdin.readline()
-                if not line:
-                    break
-                print(f'{line}', flush=True)                    
-                receiveline(line)
+            line = stream.readline()
+        except UnicodeDecodeError as e:
+            log.warning(f'Could not decode line: {e}')
+            continue
+        except ValueError:
+            line = ''
+        full = handover(lines, (time.monotonic(), line if line else None, None), full)
+        if not line:
+            break
 
-            # Handle updating details from song requests provided
-            while len(detailupdate)>0:
-                row_num, requester, song = detailupdate.pop()
+class LogFollower:
+    # Reads bump.log directly like tail -f, handing each line over with the
+    # inode and byte offset just past it so a restart can carry on from
+    # exactly there.  The file is polled; a different inode at the path
+    # means the log was rotated and the new file is read from the start,
+    # and a file shorter than where we are means it was truncated.
+    def __init__(self, path, position=None, backlog=100, interval=0.25):
+        self.path = Path(path)
+        self.position = position
+        self.backlog = backlog
+        self.interval = interval
+        self.stream = None
+        self.inode = None
+
+    def _open(self, path):
+        self.stream = open(path, 'rb')
+        self.inode = os.fstat(self.stream.fileno()).st_ino
+
+    def start(self):
+        while True:
+            try:
+                self._open(self.path)
+                break
+            except FileNotFoundError:
+                time.sleep(self.interval)
+
+        if self.position is None:
+            self._tail(self.backlog)
+            log.info(f'Following {self.path} from the last {self.backlog} lines')
+            return
+
+        inode, offset = self.position
+        if inode != self.inode:
+            # Rotated while we were down, finish the old file first if it's still around
+            for rotated in sorted(self.path.parent.glob(self.path.name + '?*')):
                 try:
-                    print(f'Updating {song} at row {row_num}')
-                    supportSheet.update_cell(row_num, 8, song)
-                except Exception as e:
-                    exc_type, exc_obj, exc_tb = sys.exc_info()
-                    fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-                    print(exc_type, fname, exc_tb.tb_lineno)
-                    print(traceback.format_exc())
-                    print("--= Some failure occured trying to add information. Adding back to songqueue =--", flush=True)
-                    songqueue.append([requester, song, False])
-
-            if len(rowqueue)>0:
-                print("Processing queue...", flush=True)
-                try:
-                    findnextrow()
-                    print("Updating google sheet...")
-                    supportSheet.append_rows(rowqueue, table_range=f'A{row}',value_input_option='USER_ENTERED', insert_data_option='INSERT_ROWS')
-                    print("Successfully updated", flush=True)
-                    row += len(rowqueue)
-                    state_path.write_text(str(row))
-                    failure_count=0
-                    rowqueue = []
-                except Exception as e:
-                    exc_type, exc_obj, exc_tb = sys.exc_info()
-                    fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-                    print(exc_type, fname, exc_tb.tb_lineno)
-                    print(traceback.format_exc())
-                    print("--= Some failure occured trying to add information. Pausing 30 seconds =--", flush=True)
-
-                    failure_count = failure_count + 1
-                    time.sleep(30*failure_count)
-
-                    # See if reopening the sheet helps
-                    gsheet = gc.open_by_key(ONG_BUMP_SPREADSHEET_ID)
-                    supportSheet= gsheet.worksheet("Support")
-
-                    if failure_count > 4:
-                        print("API Seems to not be working anymore -- exiting")
+                    if rotated.stat().st_ino == inode:
+                        self.stream.close()
+                        self._open(rotated)
                         break
-            # If there are songs that haven't been showed at the bottom of the list
-            if len(songqueue)>0:
-                for j, (requester, song, shownflag)  in enumerate(songqueue):
-                    if not shownflag:
-                        try:
-                            supportSheet.update_cell(row+j, 8, song.replace('")',' QUEUED BY '+requester+'")'))
-                            songqueue[j]=[requester, song, True]
-                        except Exception as e:
-                            print (f"Error clearing cell: {e} to remove song queue list")
-                            time.sleep(30)
-                            break
-
-            # This really isn't a thing any more -- waiting for better hype logging from ongwatch
-            if len(hypequeue)>0:
-                for hype in hypequeue:                        
-                    try:
-                        supportSheet.update_acell(hype[0],f'H{hype[1]}')
-                        print(f'Updated H{hype[1]} for Hypetrain {hype[0]}', flush=True)
-                    except:
-                        print(f'Failed to update H{hype[1]} for Hypetrain {hype[0]}', flush=True)
-                hypequeue = []
+                except OSError:
+                    pass
+            else:
+                log.info(f'{self.path} was rotated, reading the new one from the start')
+                return
+        size = self.stream.seek(0, os.SEEK_END)
+        self.stream.seek(offset if offset <= size else 0)
+        log.info(f'Following {self.stream.name} from byte {self.stream.tell()}')
+
+    def _tail(self, lines):
+        # Seek back to the start of the last few lines, like tail -n
+        pos = self.stream.seek(0, os.SEEK_END)
+        buf = b''
+        while pos > 0 and buf.count(b'\n') <= lines:
+            step = min(65536, pos)
+            pos -= step
+            self.stream.seek(pos)
+            buf = self.stream.read(step) + buf
+        cut = len(buf) - 1 if buf.endswith(b'\n') else len(buf)
+        for _ in range(lines):
+            cut = buf.rfind(b'\n', 0, cut)
+            if cut < 0:
+                break
+        self.stream.seek(pos + cut + 1 if cut >= 0 else pos)
+
+    def follow(self, lines):
+        self.start()
+        partial = b''
+        full = False
+        while True:
+            data = self.stream.readline()
+            if data:
+                partial += data
+                if not partial.endswith(b'\n'):
+                    continue
+                data, partial = partial, b''
+                try:
+                    line = data.decode('utf-8')
+                except UnicodeDecodeError as e:
+                    log.warning(f'Could not decode line: {e}')
+                    continue
+                full = handover(lines, (time.monotonic(), line, (self.inode, self.stream.tell())), full)
+                continue
+
+            # At the end, see if the file has been swapped out or cut short
+            try:
+                current = os.stat(self.path)
+            except FileNotFoundError:
+                time.sleep(self.interval)
+                continue
+            if current.st_ino != self.inode:
+                if partial:
+                    log.warning(f'Dropping unfinished line at the end of the old log: {partial!r}')
+                    partial = b''
+                self.stream.close()
+                self._open(self.path)
+                log.info(f'{self.path} was rotated, following the new one')
+                continue
+            if current.st_size < self.stream.tell():
+                log.warning(f'{self.path} was truncated, reading from the start')
+                partial = b''
+                self.stream.seek(0)
+                continue
+            time.sleep(self.interval)
+
+def readstate(state_path):
+    # The state file has the next row, then the inode and offset in the
+    # followed log when there is one
+    fields = state_path.read_text().split()
+    position = (int(fields[1]), int(fields[2])) if len(fields) >= 3 else None
+    return int(fields[0]), position
+
+# Sheet sessions
+#
+# Everything to do with keeping one sheet up to date lives in a Session:
+# its queues, row cursor, copy of the end of the sheet, song matcher, spool,
+# state file, rate budget and writer thread.  Each line is parsed once and
+# the event handed to every session, so one process can keep several sheets
+# (prod and test, say) going from the same log while sharing the reader and
+# one authenticated google client.
+class Session:
+    def __init__(self, name, sheet, state_path, spool=None, scheduler=None, mirror_ttl=60.0, song_match_expiry=0.0, flushpolicy=None):
+        self.name = name
+        self.sheet = sheet
+        self.state_path = state_path
+        self.spool = spool
+        self.scheduler = scheduler if scheduler is not None else RateScheduler(name=name)
+        self.flushpolicy = flushpolicy if flushpolicy is not None else FlushPolicy()
+        self.lock = threading.RLock()
+        self.wake = threading.Event()    # set whenever there is something new for the writer
+
+        # event queue - this is to keep from making too many API calls per minute
+        self.rowqueue = []
+        self.hypequeue = []
+        self.detailupdate = []
+        self.songqueue = []
+        self.songsseen = {}      # video id -> who asked for it first this stream
+        self.pendingrows = {}    # row id -> row, for everything queued or being written
+        self.queuedat = {}       # row id -> when the line for a pending row was read
+        self.lastid = 0          # ids for queued rows when there is no spool to number them
+        self.inflight = []       # rows taken out of rowqueue by a flush in progress
+
+        # Starting row
+        self.row = 2
+        self.rowsearchwidth = 50 # Size of the initial search
+        self.maxrows = None      # most rows a flush writes, None for all of them
+        self.lastrow = 0
+        self.ordercount = 0
+
+        self.mirror = SheetMirror(ttl=mirror_ttl)
+        self.matcher = SongMatcher(song_match_expiry, spool)
+        self.totals = StreamTotals(spool=spool)
+        self.coalescer = WriteCoalescer()
+        self.notedrows = 0           # rows under the last row holding the queued song list
+        self.replaying = Counter()   # recently consumed lines that a restart may replay
+        self.lastline = 0.0          # when the last line was parsed
+        self.oldestpending = None    # when the oldest row still waiting to be written arrived
+        self.followpos = None        # (inode, offset) just past the last line parsed from --follow
+        self.statepos = None         # followpos as of the last write, kept in the state file
+        self.skipto = None           # our saved position, when the shared reader starts before it
+        self.saveeachline = True     # save the queues to the spool after every line
+
+        self.receivers = {
+            SupportLine: self.receivesupport,
+            HypeLine: self.receivehype,
+            StreamStartLine: self.receivestreamstart,
+            StreamEndLine: self.receivestreamend,
+            SongRequestLine: self.receivesong,
+            UnknownLine: self.receiveunknown,
+        }
+
+    def queuerow(self, row):
+        # Lines already in the sheet (a restart replaying the tail of
+        # bump.log) are dropped here rather than at the next flush.  The
+        # same line twice before it is written is two rows.
+        if row.key in self.mirror.keys:
+            log.info(f'  Already in sheet: {row}')
+            return False
+        if self.oldestpending is None:
+            self.oldestpending = time.monotonic()
+        if self.spool is not None:
+            row.id = self.spool.queued(row)
+        else:
+            self.lastid += 1
+            row.id = self.lastid
+        self.rowqueue.append(row)
+        self.pendingrows[row.id] = row
+        self.queuedat[row.id] = linearrived if linearrived is not None else time.monotonic()
+        return True
+
+    def receivesupport(self, event):
+        # Every session gets the same event, so each queues its own copy
+        row = event.row.copy()
+        entry = "\t".join(map(str, row.cells())).rstrip()
+        log.info(f'Adding Entry: {entry}')
+        queued = self.queuerow(row)
+        if queued:
+            self.totals.add(row)
+
+        # This builds a map of support by member.  Replayed support is
+        # still matched, to the row it is already on, so its song request
+        # doesn't get queued again.
+        if row.kind in songsupport and row.cents is not None and (row.cents >= 1000 or row.cents == 0):
+            if not queued:
+                rownum = self.mirror.rowof(row.key)
+                if rownum is not None:
+                    self.matcher.addsupport(row.member, rownum, row.cents, None)
+                return
+
+            # A request that came in before the support gets it now
+            waiting, expired = self.matcher.takesong(row.member)
+            self.dropsongs(expired)
+            if waiting is not None:
+                log.info(f'Matched {row.member}\'s waiting request: {waiting[1]}')
+                self.totals.addmatch()
+                row.detail = waiting[1]
+                if self.spool is not None:
+                    self.spool.updated(row)
+                self.songqueue.remove(waiting)
+                return
+
+            self.matcher.addsupport(row.member, self.row+len(self.inflight)+len(self.rowqueue)-1, row.cents, row.id)
+
+    def dropsongs(self, expired):
+        # Songs that waited too long for support come out of the notes
+        if expired:
+            gone = {id(entry) for entry in expired}
+            self.songqueue = [entry for entry in self.songqueue if id(entry) not in gone]
+            for requester, song, shownflag in expired:
+                log.info(f'{requester}\'s request expired waiting for support: {song}')
+
+    def receivehype(self, event):
+        log.info(f'Hype: {event.level}')
+        if event.level:
+            level = event.level -1
+            # New way to record Hype Trains Directly
+            if self.queuerow(Event.fromcells([event.when,"","","Hype Train End","Hype","0.00","na", f'Completed Level {level}'])):
+                self.totals.hype(level)
 
-            # Print a dot every second to keep the user entertained while we wait for data
-            # print('.',end='',flush=True)
+            # Old way.  If nothing adds to the queue, it will not do anything.  Later to remove this code.
+            # self.hypequeue.append([f'Hypetrain Completed Level {level}',self.row+len(self.rowqueue)-1])
+
+    def receivestreamstart(self, event):
+        log.info(f'Stream Start: {event.when}')
+        self.queuerow(Event.fromcells([event.when,"","","STREAM START","","","",""]))
+        self.matcher.clear()    # Erase the support queue
+        self.songqueue=[]    # Erase the song queue
+        self.songsseen = {}
+        if self.spool is not None:
+            self.spool.removeall('seen')
+        self.totals.clear()
+
+    def receivestreamend(self, event):
+        log.info(f'Stream End: {event.when}')
+        row = Event.fromcells([event.when,"","","STREAM END","","","",""])
+        if not self.totals.empty():
+            row.detail = self.totals.summary()
+            log.info(f'Stream Summary: {row.detail}')
+        self.queuerow(row)
+        self.matcher.clear()    # Erase the support queue
+        self.songqueue=[]    # Erase the song queue
+        self.songsseen = {}
+        if self.spool is not None:
+            self.spool.removeall('seen')
+        self.totals.clear()
+
+    def receivesong(self, event):
+        requester = event.requester
+        song = remove_inside_quotes(event.payload)
+        log.info(f'Song Request from {requester}: {song}')
+
+        match = self.matcher.takesupport(requester)
+        self.totals.addrequest()
+
+        # The same video asked for twice in a stream
+        link = parsesonglink(event.payload)
+        if link is not None and link.videoid is not None:
+            if link.videoid in self.songsseen:
+                log.info(f'{requester} asked for {link.videoid}, already requested by {self.songsseen[link.videoid]} this stream')
+                metrics.inc('ongautobump_duplicate_songs_total', target=self.name)
+            else:
+                self.songsseen[link.videoid] = requester
+                if self.spool is not None:
+                    self.spool.put('seen', link.videoid, requester)
+        if match is None:
+            entry = [requester, song, False]
+            self.songqueue.append(entry)
+            self.matcher.addsong(entry)
+            log.info(f'No match found for {requester}\'s request. Added to songqueue')
+            return
+
+        (member, row_num, amount, rowid, added, entryid) = match
+        self.totals.addmatch()
+
+        row = self.pendingrows.get(rowid) if rowid is not None else None
+        if row is not None:
+            # Not written yet, so it goes out with the row.  If the row is
+            # being written right now, the writer notices and sends the detail
+            row.detail = f'{song}'
+            if self.spool is not None:
+                self.spool.updated(row)
+        else:
+            # Add to detailupdate array, the writer sends it with the next flush
+            self.detailupdate.append([row_num, requester, song])
+
+    def receiveunknown(self, event):
+        log.info(f'Did not understand: {event.line}')
+
+    def receive(self, line, event, position=None):
+        # One line from the log, already classified
+        with self.lock:
+            if position is not None:
+                if self.skipto is not None and position[0] == self.skipto[0] and position[1] <= self.skipto[1]:
+                    # The reader started further back for another session
+                    return
+                self.skipto = None
+                self.followpos = position
+            if not self.replayed(line):
+                if self.spool is not None:
+                    self.spool.line(line)
+                if event is not None:
+                    self.receivers[type(event)](event)
+                if self.saveeachline:
+                    self.savequeues()
+            self.lastline = time.monotonic()
+        self.wake.set()
+
+    def readsheettail(self):
+        # Expand size of the search window based on input size
+        if len(self.rowqueue) > self.rowsearchwidth:
+            self.rowsearchwidth=len(self.rowqueue)*4
+
+        # Failures go back to the caller, which backs off and tries again
+        nextrow, probes = locatetail(self.sheet, self.row)
+        log.info(f'Found last blank row {nextrow} in {probes} probes (expected {self.row})')
+        metrics.inc('ongautobump_tail_probes_total', probes, target=self.name)
+        self.row = nextrow
+
+        # Only the rows just above it are read, to spot support already in
+        # the sheet
+        startrow = max(2, self.row - self.rowsearchwidth)
+        tail = []
+        if startrow < self.row:
+            data = self.sheet.get(f'A{startrow}:G{self.row-1}', pad_values=True)
+            log.debug(f'Data received: {len(data)}')
+            for rowpos, datarow in enumerate(data, startrow):
+                newrow = normalizecells(datarow)
+                while len(newrow) < 4:
+                    newrow.append('')
+                tail.append((rowpos, newrow))
+        self.rowsearchwidth = 10 # Reduce future search width
+
+        self.mirror.size = max(self.mirror.size, len(tail))
+        self.mirror.seed(tail, self.row)
+
+    def refreshmirror(self):
+        # Only go back to the sheet if the local copy can't be trusted
+        # Checking it can wait if we are short on read quota
+        if self.mirror.nextrow is None or (self.mirror.expired() and self.scheduler.ready('read') and not self.mirror.check(self.sheet)):
+            self.readsheettail()
+        else:
+            log.debug(f'Using cached end of sheet, next row {self.mirror.nextrow}')
+
+    def findnextrow(self):
+        started = time.perf_counter()
+        self.row = self.mirror.nextrow
+
+        # The order column carries on from the last row in the sheet
+        if self.mirror.lastorder() is not None:
+            self.ordercount = self.mirror.lastorder()
+
+        # Anything that has made it into the sheet since it was queued
+        newrowqueue = []
+        dropped = []
+        for r in range(0,len(self.rowqueue)):
+            if self.rowqueue[r].key in self.mirror.keys:
+                log.info(f'  Already in sheet: ${self.rowqueue[r]}')
+                dropped.append(self.rowqueue[r])
+                # Decrease and hype count row by one
+                for i in range(len(self.hypequeue)):
+                    self.hypequeue[i][1]-=1
+            else:
+                newrowqueue.append(self.rowqueue[r])
+        self.rowqueue = newrowqueue
+        for row in dropped:
+            self.pendingrows.pop(row.id, None)
+            self.queuedat.pop(row.id, None)
+            # A song matched to it while it was queued goes on the row that
+            # is already there, and so do any that match it later
+            rownum = self.mirror.rowof(row.key)
+            if rownum is not None:
+                self.matcher.placed(row.id, rownum)
+                if row.detail:
+                    self.detailupdate.append([rownum, row.member, row.detail])
+        if self.spool is not None and len(dropped)>0:
+            self.spool.dropped(dropped)
+
+        # Find the last row not likely to have anything in the comment field
+        rowqueue = self.rowqueue
+        if len(rowqueue)>0:
+            for r in range(0,len(rowqueue)):
+                # Generate the order column, if STREAM START, then ordercount is an offset from r+1
+                if rowqueue[r].member == "STREAM START" or rowqueue[r].member == "STREAM END":
+                    self.ordercount=(-r-1)
+                rowqueue[r].order = r+self.ordercount+1
+                if rowqueue[r].cents is not None and rowqueue[r].cents < 2499:
+                    self.lastrow = self.row + r
+        metrics.observe('ongautobump_findnextrow_seconds', time.perf_counter() - started, target=self.name)
+
+        log.info(f'Next blank row: {self.row} New rows to add: {len(rowqueue)}')
+
+        # Every row on every flush is too much for the log unless asked for
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('To Add:\n' + '\n'.join(str(row) for row in rowqueue))
+
+    def savequeues(self):
+        # The matcher, totals and songs seen are written through as they
+        # change, this is the rest and the commit
+        if self.spool is not None:
+            self.spool.save('detailupdate', self.detailupdate)
+            self.spool.save('notedrows', self.notedrows)
+            self.spool.save('follow', self.followpos)
+            self.spool.commit()
+
+    def restorespool(self):
+        # Pick up where the last run left off, returns False on a fresh spool
+        spool = self.spool
+        saved = spool.load('row')
+        if saved is None:
+            return False
+        self.row = saved
+        self.rowqueue = spool.pending()
+        self.pendingrows.update((row.id, row) for row in self.rowqueue)
+        # Queued songs come back as not shown yet, so the list under the
+        # last row is written again once
+        self.songqueue = self.matcher.load()
+        self.songsseen = dict(spool.items('seen'))
+        self.totals.load()
+        self.detailupdate = spool.load('detailupdate', [])
+        self.notedrows = spool.load('notedrows', 0)
+        self.replaying = spool.recentlines()
+        tail = spool.tail()
+        if tail:
+            self.mirror.seed([(rownum, normalizecells([str(item) for item in items[0:7]])) for rownum, items in tail], self.row)
+            # Mods may have added rows while we were down
+            self.mirror.expire()
+        log.info(f'Restored {self.name} from spool: row {self.row}, {len(self.rowqueue)} pending rows, {len(self.matcher)} supports, {len(self.songqueue)} songs')
+        return True
+
+    def replayed(self, line):
+        # While a restart replays the end of bump.log, skip what we already read
+        if self.replaying[line] > 0:
+            self.replaying[line] -= 1
+            log.info(f'Already read before restart: {line.rstrip()}')
+            return True
+        self.replaying.clear()
+        return False
+
+    def restore(self, line=None, follow=False):
+        # Where to start: --line, then the spool, then the state file
+        if line is not None:
+            self.row = line
+            if self.state_path.exists():
+                self.statepos = readstate(self.state_path)[1]
+            self.writestate()
+            if self.spool is not None:
+                self.spool.save('row', self.row)
+                self.spool.commit()
+
+        if self.spool is not None and line is None and self.restorespool():
+            self.followpos = self.statepos = tuple(self.spool.load('follow') or ()) or None
+            self.writestate()
+        else:
+            self.row, self.statepos = readstate(self.state_path)
+            self.followpos = self.statepos
+
+        # Following the log from a saved position there's nothing to replay,
+        # and the end of the sheet can wait for the first write
+        if not follow:
+            self.followpos = self.statepos = None
+        if self.followpos is not None:
+            self.replaying.clear()
+
+    def readtail(self, max_failures):
+        # Read the end of the sheet once now, flushes work from the local copy
+        while self.mirror.nextrow is None and self.followpos is None:
+            try:
+                self.readsheettail()
+                self.scheduler.succeeded()
+            except Exception as e:
+                log.warning(f'Could not read the end of the sheet for {self.name}: {e}', exc_info=True)
+                if self.scheduler.failures >= max_failures:
+                    sys.exit(f"Google Sheet Exception {e}")
+                delay = self.scheduler.failed(e)
+                log.warning(f'Retrying in {delay:.1f} seconds')
+                time.sleep(delay)
+
+    def writestate(self):
+        text = str(self.row)
+        if self.statepos is not None:
+            text += f'\n{self.statepos[0]} {self.statepos[1]}\n'
+        self.state_path.write_text(text)
+
+    def havepending(self):
+        notesdirty = len(self.songqueue) != self.notedrows or any(not shownflag for (requester, song, shownflag) in self.songqueue)
+        return len(self.rowqueue)>0 or len(self.detailupdate)>0 or len(self.hypequeue)>0 or notesdirty
+
+    def pipelinestats(self):
+        now = time.monotonic()
+        return {
+            'lines_waiting': linequeue.qsize(),
+            'line_lag': linelag,
+            'rows_pending': len(self.rowqueue),
+            'rows_inflight': len(self.inflight),
+            'pending_age': now - self.oldestpending if self.oldestpending is not None else 0.0,
+        }
+
+    def showstats(self):
+        stats = self.pipelinestats()
+        return (f'{stats["rows_pending"]} rows pending, {stats["rows_inflight"]} being written, '
+                f'oldest {stats["pending_age"]:.1f}s')
+
+    def flushqueues(self):
+        # Write everything queued in one request, returns False if it failed
+        log.debug(f"Processing queue for {self.name}...")
+        sheet = self.sheet
+        coalescer = self.coalescer
+        calls = Counter(sheet.calls)
+        started = time.monotonic()
+        batch = []
+        details = []
+        hypes = []
+        try:
+            self.refreshmirror()
+
+            with self.lock:
+                notesdirty = len(self.rowqueue)>0 or len(self.songqueue) != self.notedrows or any(not shownflag for (requester, song, shownflag) in self.songqueue)
+                if len(self.rowqueue)>0:
+                    self.findnextrow()
+                if self.maxrows is None:
+                    batch, self.rowqueue = self.rowqueue, []
+                else:
+                    batch, self.rowqueue = self.rowqueue[:self.maxrows], self.rowqueue[self.maxrows:]
+                details, self.detailupdate = self.detailupdate, []
+                hypes, self.hypequeue = self.hypequeue, []
+                songs = list(self.songqueue)
+                self.inflight = batch
+                sentsongs = [row.detail for row in batch]
+                batchpos = self.followpos
+                firstrow = self.row
+                newrow = self.row + len(batch)
+
+                # Details from song requests provided
+                for row_num, requester, song in details:
+                    log.info(f'Updating {song} at row {row_num}')
+                    coalescer.cell(row_num, 8, song)
+
+                if len(batch)>0:
+                    log.debug("Updating google sheet...")
+                    coalescer.rows(firstrow, batch)
+
+                # Songs that haven't matched any support are listed under
+                # the last row, blanking out any of the old list left over
+                notes = [song.replace('")',' QUEUED BY '+requester+'")') for (requester, song, shownflag) in songs]
+                notes += ['']*max(0, firstrow + self.notedrows - newrow - len(notes))
+                if len(notes)>0 and notesdirty:
+                    coalescer.column(newrow, 8, notes)
+
+                # This really isn't a thing any more -- waiting for better hype logging from ongwatch
+                for hype in hypes:
+                    log.info(f'Updating H{hype[1]} for Hypetrain {hype[0]}')
+                    coalescer.cell(hype[1], 8, hype[0])
+
+            coalescer.flush(sheet)
+
+            with self.lock:
+                self.scheduler.charge(calls, sheet.calls)
+                self.scheduler.succeeded()
+                log.debug("Successfully updated")
+
+                if len(batch)>0:
+                    self.mirror.add(firstrow, batch)
+                    self.row = newrow
+                if len(batch)>0 or batchpos != self.statepos:
+                    # Everything read up to batchpos is in the sheet now
+                    self.statepos = batchpos
+                    self.writestate()
+                if self.spool is not None:
+                    self.spool.sent(firstrow, batch)
+                    self.spool.save('row', self.row)
+                    self.spool.prune()
+                written = time.monotonic()
+                metrics.observe('ongautobump_flush_seconds', written - started, target=self.name)
+                metrics.inc('ongautobump_rows_written_total', len(batch), target=self.name)
+                for i, row in enumerate(batch):
+                    self.pendingrows.pop(row.id, None)
+                    arrived = self.queuedat.pop(row.id, None)
+                    if arrived is not None:
+                        metrics.observe('ongautobump_event_to_sheet_seconds', written - arrived, target=self.name)
+                    self.matcher.placed(row.id, firstrow + i)
+                    if row.detail != sentsongs[i]:
+                        # Matched to a song while it was being written
+                        self.detailupdate.append([firstrow + i, row.member, row.detail])
+                self.inflight = []
+                for entry in songs:
+                    entry[2] = True
+                self.notedrows = len(songs)
+                self.oldestpending = started if len(self.rowqueue)>0 else None
+                self.savequeues()
+                if len(self.rowqueue)>0:
+                    self.wake.set()
+            return True
 
-        except StopIteration:
-            print('EOF! Terminating')
+        except Exception as e:
+            coalescer.discard()
+            with self.lock:
+                self.scheduler.charge(calls, sheet.calls)
+                # Put it all back to go out with the next try
+                self.rowqueue = batch + self.rowqueue
+                self.inflight = []
+                self.detailupdate = details + self.detailupdate
+                self.hypequeue = hypes + self.hypequeue
+            log.warning(f'Could not write to the sheet for {self.name}: {e}', exc_info=True)
+            delay = self.scheduler.failed(e)
+            log.warning(f"--= Some failure occured trying to add information. Backing off {delay:.1f} seconds =--")
+
+            # See if reopening the sheet helps, unless it was just the quota
+            if errorcode(e) != 429:
+                try:
+                    sheet.reopen()
+                except Exception as e:
+                    log.warning(f'Could not reopen the sheet: {e}')
+            return False
+
+    def writeloop(self, max_failures):
+        scheduler = self.scheduler
+        waitshown = False
+        while True:
+            self.wake.wait(1.0)
+            self.wake.clear()
+
+            with self.lock:
+                if self.matcher.expiry > 0:
+                    self.dropsongs(self.matcher.expire())
+                pending = self.havepending()
+            if not pending:
+                if inputdone.is_set():
+                    return
+                continue
+
+            # Hold off while a burst is still coming in so it goes out together
+            if inputdone.is_set():
+                reason = 'eof'
+            else:
+                with self.lock:
+                    rows = len(self.rowqueue)
+                    oldest = self.oldestpending if self.oldestpending is not None else self.lastline
+                    lastline = self.lastline
+                wait, reason = self.flushpolicy.due(rows, oldest, lastline)
+                if reason is None:
+                    self.wake.wait(wait)
+                    self.wake.set()     # look again without waiting another second
+                    continue
+
+            if not scheduler.ready('write'):
+                # Lines keep being read, they go out together once we can write
+                if not waitshown:
+                    log.info(f'Holding {self.name} for {scheduler.wait("write"):.1f}s to stay under quota: {showstats()}')
+                    waitshown = True
+                time.sleep(min(1.0, scheduler.wait('write')))
+                continue
+
+            waitshown = False
+            metrics.inc('ongautobump_flushes_total', reason=reason, target=self.name)
+            if not self.flushqueues() and scheduler.failures > max_failures:
+                log.error(f"API Seems to not be working anymore for {self.name} -- exiting")
+                return
+
+    def close(self):
+        self.savequeues()
+        if self.spool is not None:
+            self.spool.close()
+        self.sheet.close()
+
+def receiveline(line, position=None):
+    # Parse once, then every session gets the event
+    started = time.perf_counter()
+    event = classifyline(line)
+    for session in sessions:
+        session.receive(line, event, position)
+    if event is not None:
+        if type(event) is SupportLine:
+            kind = event.row.kind.name.lower()
+        else:
+            kind = eventtypes[type(event)]
+        metrics.inc('ongautobump_events_total', type=kind)
+    metrics.inc('ongautobump_lines_total')
+    metrics.observe('ongautobump_parse_seconds', time.perf_counter() - started)
+
+def showstats():
+    text = f'{linequeue.qsize()} lines waiting ({linelag:.1f}s behind)'
+    for session in sessions:
+        text += f', {session.name + ": " if len(sessions) > 1 else ""}{session.showstats()}'
+    return text
+
+def startsessions(args, sheet=None):
+    # One session per --target, all sharing the one client
+    client = open_client(args) if sheet is None else None
+    started = []
+    for statefile, sheetid, worksheet in args.target or [(args.statefile, args.gsheets_id, "Support")]:
+        state_path = Path(__file__).resolve().parent / statefile
+        backend = sheet if sheet is not None else open_backend(args, client, sheetid, worksheet, state_path.with_suffix('.sheet'))
+        spool = None
+        if not args.no_spool:
+            spool = Spool(args.spool or state_path.with_suffix('.spool'))
+            spool.prune()
+            spool.commit()
+        name = Path(statefile).stem
+        session = Session(name, MeteredSheet(backend, name), state_path, spool,
+                          RateScheduler(args.read_quota, args.write_quota, name=name),
+                          args.mirror_ttl, args.song_match_expiry,
+                          FlushPolicy(args.flush_min_delay, args.flush_max_delay, args.flush_idle, args.flush_rows))
+        session.restore(args.line, args.follow is not None)
+        started.append(session)
+    return started
+
+
+def importlines(logfile, since=None, until=None):
+    # Lines from a log within [since, until).  Lines without a time of their
+    # own (song requests) go with the last line that had one.
+    when = None
+    for line in logfile:
+        if validdate.match(line):
+            when = line[0:19]
+        if since is not None and (when is None or when < since):
+            continue
+        if until is not None and when is not None and when >= until:
+            continue
+        yield line
+
+def backfill(args, sheet=None):
+    # Catching up on a log the live loop missed.  The whole log is parsed
+    # first, so the end of the sheet is read once with a window as big as
+    # the import, findnextrow() drops what is already there and numbers the
+    # Order column across all of it, and the rows go out in as few writes
+    # as --import-chunk allows.
+    global sessions
+    sessions = startsessions(args, sheet)
+    for session in sessions:
+        # An import that dies is just run again, so the spool is only
+        # brought up to date once everything is parsed
+        session.saveeachline = False
+    lines = 0
+    started = time.monotonic()
+    with open(args.import_log, encoding='utf-8', errors='replace') as logfile:
+        for line in importlines(logfile, args.since, args.until):
+            receiveline(line)
+            lines += 1
+    log.info(f'Read {lines} lines from {args.import_log} in {time.monotonic() - started:.1f}s: {showstats()}')
+    for session in sessions:
+        session.savequeues()
+        # The spool only remembers the last few rows written, the import
+        # needs a tail as long as itself to drop what is already there
+        session.mirror.invalidate()
+
+    inputdone.set()
+    for session in sessions:
+        session.maxrows = args.import_chunk
+        session.wake.set()
+        session.writeloop(args.max_failures)
+        log.info(f'{session.name}: {session.coalescer.stats["requests"]} write requests for {session.coalescer.stats["rows"]} rows')
+    log.info(f'Finished: {showstats()}')
+    log.info(metrics.summary())
+
+    for session in sessions:
+        session.close()
+    closelogging()
+    return 0
+
+def main(argv: Optional[List[str]] = None, sheet: Optional[SheetBackend] = None) -> int:
+    global sessions
+    global linequeue
+    global linelag
+    global linearrived
+    global readyafter
+
+    args = parse_args(argv)
+    setuplogging(args.log_level, args.log_json, args.log_burst)
+    inputdone.clear()
+    if args.metrics_port is not None:
+        servemetrics(args.metrics_host, args.metrics_port)
+    if args.import_log is not None:
+        return backfill(args, sheet)
+
+    # A sheet can be handed in directly, which is how the benchmarks run
+    sessions = startsessions(args, sheet)
+    for session in sessions:
+        session.readtail(args.max_failures)
+
+    # The log is read from the earliest saved position, sessions that got
+    # further skip ahead to where they were
+    linequeue = queue.Queue(maxsize=args.max_lines)
+    if args.follow is not None:
+        positions = [session.followpos for session in sessions]
+        start = None
+        if None not in positions and len({inode for inode, offset in positions}) == 1:
+            start = min(positions)
+        for session in sessions:
+            if session.followpos is not None and session.followpos != start:
+                session.skipto = session.followpos
+        follower = LogFollower(args.follow, start, args.follow_backlog, args.follow_interval)
+        reader = threading.Thread(target=follower.follow, args=(linequeue,), name="reader", daemon=True)
+    else:
+        reader = threading.Thread(target=readlines, args=(sys.stdin, linequeue), name="reader", daemon=True)
+    writers = [threading.Thread(target=session.writeloop, args=(args.max_failures,), name=f"writer-{session.name}", daemon=True)
+               for session in sessions]
+    reader.start()
+    for writer in writers:
+        writer.start()
+    if args.stats_interval > 0:
+        threading.Thread(target=statsloop, args=(args.stats_interval,), name="stats", daemon=True).start()
+
+    readyafter = time.monotonic() - processstart
+    log.info(f"Ready for data... ({readyafter:.2f}s after start)")
+    # Ok take stdin and enter into bump log 
+    while all(writer.is_alive() for writer in writers):
+        try:
+            arrived, line, position = linequeue.get(timeout=1.0)
+        except queue.Empty:
+            continue
+        if line is None:
             break
-    print('EOF! Terminating')
+
+        log.debug('Reading Line: %s', line.rstrip('\n'))
+        linelag = time.monotonic() - arrived
+        linearrived = arrived
+        receiveline(line, position)
+
+    # Let the writers finish off what's queued
+    inputdone.set()
+    for session in sessions:
+        session.wake.set()
+    for writer in writers:
+        writer.join()
+    log.info(f'Finished: {showstats()}')
+    log.info(metrics.summary())
+
+    for session in sessions:
+        session.close()
+    log.info('EOF! Terminating')
+    closelogging()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,449 @@
+#!/usr/bin/env -S uv run --script --quiet
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import ongautobump
+
+# Replays bump.log streams through ongautobump against the local sheet
+# stand-in and reports how fast lines get in, how many API calls it took and
+# how long each line took to land in the sheet.
+#
+#   ./ongautobump_bench.py                      all the synthetic scenarios
+#   ./ongautobump_bench.py --log bump.log       a recorded log as well
+#   ./ongautobump_bench.py --json run.json      save results for later
+#   ./ongautobump_bench.py --baseline run.json  compare against a saved run
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Benchmark ongautobump with recorded or synthetic bump.log streams",
+    )
+
+    parser.add_argument(
+        "--log",
+        type=Path,
+        action="append",
+        default=[],
+        help="recorded bump.log to replay (can be given more than once)"
+    )
+
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        default=None,
+        help="synthetic scenario to run (default: all of them)"
+    )
+
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=200,
+        help="number of events in each synthetic scenario"
+    )
+
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0.0,
+        help="lines per second to feed recorded logs at (0 is as fast as possible)"
+    )
+
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="simulated seconds of latency per sheet API call"
+    )
+
+    parser.add_argument(
+        "--parse-repeat",
+        type=int,
+        default=20,
+        help="how many times to run each scenario through receiveline() for the parse timing"
+    )
+
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=1042,
+        help="random seed for the synthetic scenarios"
+    )
+
+    parser.add_argument(
+        "--microbench",
+        type=int,
+        default=None,
+        metavar="LINES",
+        help="just time per line parse cost on a synthetic log this many lines long"
+    )
+
+    parser.add_argument(
+        "--json",
+        type=Path,
+        default=None,
+        help="write the results to this file"
+    )
+
+    parser.add_argument(
+        "--baseline",
+        type=Path,
+        default=None,
+        help="results file from an earlier run to compare against"
+    )
+
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="show the output from ongautobump while it runs"
+    )
+
+    return parser.parse_args()
+
+
+# Synthetic scenarios
+#
+# Each one returns a list of (offset seconds, line) so bursts arrive the way
+# they do in a real stream.  Every event gets a unique timestamp/member so the
+# rows can be matched back up with the line that produced them.
+
+def stamp(start, seconds):
+    return (start + timedelta(seconds=seconds)).strftime('%Y-%m-%d %H:%M:%S')
+
+def support_line(when, gifter, member, kind, amount):
+    return f'{when}\t\t{gifter}\t{member}\t{kind}\t${amount:.2f}\tna\t\n'
+
+def song_line(member, n):
+    return f'SONG REQUEST FROM {member}: =HYPERLINK("https://www.youtube.com/watch?v=bench{n:06d}", "Bench Song {n}")\n'
+
+def scenario_bits(size, rng, start):
+    lines = []
+    for i in range(size):
+        # A bit flood: lots of small cheers a fraction of a second apart
+        lines.append((i*0.02, support_line(stamp(start, i), '', f'cheerer{i}', 'Bits', rng.randint(1, 500)/100)))
+    return lines
+
+def scenario_giftbomb(size, rng, start):
+    lines = []
+    offset = 0.0
+    i = 0
+    while i < size:
+        # Like lego1042 in the examples: a batch of gifts with one timestamp,
+        # spread over a few seconds as ongwatch writes them out
+        gifter = f'gifter{i}'
+        bomb = min(50, size - i)
+        for j in range(bomb):
+            lines.append((offset + j*3.0/bomb, support_line(stamp(start, i), gifter, f'giftee{i+j}', 'Sub', 5.00)))
+        i += bomb
+        offset += 5.0
+    return lines
+
+def scenario_songstorm(size, rng, start):
+    lines = []
+    offset = 0.0
+    for i in range(size//2):
+        member = f'requester{i}'
+        tip = support_line(stamp(start, i), '', member, rng.choice(['Tip', 'Bits']), rng.choice([10, 15, 20, 25, 50]))
+        # Sometimes the song shows up before the tip does
+        if rng.random() < 0.2:
+            lines.append((offset, song_line(member, i)))
+            lines.append((offset + 0.1, tip))
+        else:
+            lines.append((offset, tip))
+            lines.append((offset + 0.1, song_line(member, i)))
+        offset += 0.05
+    return lines
+
+def scenario_stream(size, rng, start):
+    # A compressed whole stream: online, a mix of everything, offline
+    lines = [(0.0, f'{stamp(start, 0)} === ONLINE (type=live @ {start.strftime("%Y-%m-%dT%H:%M:%SZ")} ===\n')]
+    offset = 0.0
+    for i in range(size):
+        offset += rng.expovariate(20)
+        when = stamp(start, i+1)
+        pick = rng.random()
+        if pick < 0.4:
+            lines.append((offset, support_line(when, '', f'viewer{i}', 'Bits', rng.randint(1, 2000)/100)))
+        elif pick < 0.6:
+            lines.append((offset, support_line(when, '', f'viewer{i}', f'Sub #{rng.randint(1, 100)}', 5.00)))
+        elif pick < 0.7:
+            lines.append((offset, support_line(when, 'bomber', f'viewer{i}', 'Sub', 5.00)))
+        elif pick < 0.9:
+            lines.append((offset, support_line(when, '', f'viewer{i}', 'Tip', rng.choice([10, 20, 35]))))
+            lines.append((offset + 0.1, song_line(f'viewer{i}', i)))
+        else:
+            lines.append((offset, f'{when} === HYPE TRAIN END (level={rng.randint(1, 5)}) ===\n'))
+    lines.append((offset + 0.1, f'{stamp(start, size+1)} === OFFLINE ===\n'))
+    return lines
+
+SCENARIOS = {
+    'bits': scenario_bits,
+    'giftbomb': scenario_giftbomb,
+    'songstorm': scenario_songstorm,
+    'stream': scenario_stream,
+}
+
+def recorded(path, rate):
+    lines = []
+    for i, line in enumerate(path.read_text().splitlines(keepends=True)):
+        lines.append((i/rate if rate else 0.0, line))
+    return lines
+
+
+class RecordingSheet(ongautobump.LocalSheet):
+    # Notes when each row lands so it can be matched with the line it came from
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.landed = {}
+
+    def batch_update(self, data, value_input_option=None):
+        result = super().batch_update(data, value_input_option=value_input_option)
+        now = time.monotonic()
+        for update in data:
+            for values_row in update['values']:
+                if len(values_row) > 4:
+                    self.landed.setdefault(row_key(values_row), now)
+        return result
+
+
+def row_key(items):
+    # Date, gifter, member and type identify a row in all of the scenarios
+    return tuple(str(item).strip() for item in items[0:1] + items[2:5])
+
+def line_key(line):
+    items = line.split('\t')
+    if len(items) > 4:
+        return row_key(items)
+    return None
+
+
+def reset_state(spool=None):
+    # A fresh session to parse into, main() sets up its own
+    ongautobump.metrics.reset()
+    ongautobump.linearrived = None
+    ongautobump.sessions = [ongautobump.Session('bench', RecordingSheet(), None, spool)]
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values)-1, int(round(pct/100*(len(values)-1))))]
+
+
+def bench_parse(lines, repeat, verbose):
+    # receiveline() on its own, with no sheet in the way
+    elapsed = 0.0
+    for _ in range(repeat):
+        reset_state()
+        with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()):
+            start = time.perf_counter()
+            for _, line in lines:
+                ongautobump.receiveline(line)
+            elapsed += time.perf_counter() - start
+    return len(lines)*repeat/elapsed if elapsed else 0.0
+
+
+def bench_loop(lines, latency, verbose):
+    # The whole main() loop, fed through a pipe the way tail feeds it
+    reset_state()
+    sheet = RecordingSheet(latency=latency)
+    sent = {}
+
+    readfd, writefd = os.pipe()
+    stdin = sys.stdin
+    sys.stdin = os.fdopen(readfd, 'r')
+
+    def feed():
+        with os.fdopen(writefd, 'w') as pipe:
+            begin = time.monotonic()
+            for offset, line in lines:
+                delay = begin + offset - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                key = line_key(line)
+                if key is not None:
+                    sent.setdefault(key, time.monotonic())
+                pipe.write(line)
+                pipe.flush()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        statefile = str(Path(tmpdir) / 'bench.state')
+        feeder = threading.Thread(target=feed, daemon=True)
+        try:
+            with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()):
+                start = time.monotonic()
+                feeder.start()
+                ongautobump.main(['--backend', 'local', '--line', '2', '--statefile', statefile], sheet=sheet)
+                elapsed = time.monotonic() - start
+        finally:
+            feeder.join()
+            sys.stdin.close()
+            sys.stdin = stdin
+
+    latencies = [sheet.landed[key] - when for key, when in sent.items() if key in sheet.landed]
+    return {
+        'elapsed': elapsed,
+        'events': len(sent),
+        'landed': len(latencies),
+        'latencies': latencies,
+        'calls': dict(sheet.calls),
+    }
+
+
+def run_scenario(name, lines, args):
+    parse_rate = bench_parse(lines, args.parse_repeat, args.verbose)
+    loop = bench_loop(lines, args.latency, args.verbose)
+    calls = sum(loop['calls'].values())
+    events = loop['events'] or 1
+    return {
+        'scenario': name,
+        'lines': len(lines),
+        'events': loop['events'],
+        'landed': loop['landed'],
+        'parse_lines_per_sec': parse_rate,
+        'loop_lines_per_sec': len(lines)/loop['elapsed'] if loop['elapsed'] else 0.0,
+        'api_calls': calls,
+        'api_calls_per_100_events': calls*100/events,
+        'calls_by_method': loop['calls'],
+        'latency_p50': percentile(loop['latencies'], 50),
+        'latency_p90': percentile(loop['latencies'], 90),
+        'latency_p99': percentile(loop['latencies'], 99),
+        'latency_max': max(loop['latencies'], default=0.0),
+    }
+
+
+def legacy_classify(line):
+    # How receiveline() used to pick a line apart, kept to compare against:
+    # patterns compiled on every call and tried one after another
+    validdate = re.compile("^20[0-9][0-9]-[0-9][0-9]-[0-9][0-9]")
+    eventstring = re.compile(" ===")
+    hypeend = re.compile("=== HYPE TRAIN END")
+    hypelevel = re.compile(r'level=(\d*)')
+    streamstart = re.compile("=== ONLINE")
+    streamend = re.compile("=== OFFLINE")
+    songrequest = re.compile(r'SONG REQUEST FROM ([^:]+): (=HYPERLINK.*)')
+
+    items = line.split("\t")
+    if len(items) > 1 and validdate.match(items[0]):
+        if not eventstring.match(items[1]):
+            return 'support'
+        return None
+    elif hypeend.search(line):
+        return ('hype', hypelevel.search(line).group(1))
+    elif streamstart.search(line):
+        return 'start'
+    elif streamend.search(line):
+        return 'end'
+    elif songrequest.search(line):
+        songdetail = songrequest.search(line)
+        return ('song', songdetail.group(1), songdetail.group(2))
+    return 'unknown'
+
+
+def microbench(count, rng, start, verbose):
+    lines = [line for offset, line in scenario_stream(count, rng, start)]
+    results = []
+
+    for name, parse in [('legacy classify', legacy_classify), ('classifyline', ongautobump.classifyline)]:
+        begin = time.perf_counter()
+        for line in lines:
+            parse(line)
+        elapsed = time.perf_counter() - begin
+        results.append((name, elapsed, len(lines)))
+
+    reset_state()
+    with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()):
+        begin = time.perf_counter()
+        for line in lines:
+            ongautobump.receiveline(line)
+        elapsed = time.perf_counter() - begin
+    results.append(('receiveline', elapsed, len(lines)))
+
+    # The same again writing to the spool, as main() does unless --no-spool
+    with tempfile.TemporaryDirectory() as tmpdir:
+        spool = ongautobump.Spool(Path(tmpdir) / 'bench.spool')
+        reset_state(spool)
+        with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()):
+            begin = time.perf_counter()
+            for line in lines:
+                ongautobump.receiveline(line)
+            elapsed = time.perf_counter() - begin
+        spool.close()
+    results.append(('receiveline+spool', elapsed, len(lines)))
+
+    sheetrows = [['2026-6-11 22:%d:%d' % (i//60 % 60, i % 60), str(i), '', f'viewer\xa0{i}', 'Bits', '$1.00', 'na'] for i in range(count)]
+    begin = time.perf_counter()
+    for cells in sheetrows:
+        ongautobump.normalizecells(cells)
+    results.append(('normalizecells', time.perf_counter() - begin, len(sheetrows)))
+
+    for name, elapsed, done in results:
+        print(f'{name:<18} {done:>8} lines {elapsed*1e9/done:>8.0f} ns/line {done/elapsed:>12.0f} lines/s')
+
+
+def report(results, baseline):
+    before = {}
+    if baseline is not None:
+        before = {result['scenario']: result for result in json.loads(baseline.read_text())}
+
+    print(f'{"scenario":<14} {"lines":>6} {"landed":>7} {"parse/s":>10} {"loop/s":>8} {"calls":>6} {"/100ev":>7} {"p50":>7} {"p90":>7} {"p99":>7} {"max":>7}')
+    for result in results:
+        print(f'{result["scenario"]:<14} {result["lines"]:>6} {result["landed"]:>7} '
+              f'{result["parse_lines_per_sec"]:>10.0f} {result["loop_lines_per_sec"]:>8.1f} '
+              f'{result["api_calls"]:>6} {result["api_calls_per_100_events"]:>7.1f} '
+              f'{result["latency_p50"]:>7.3f} {result["latency_p90"]:>7.3f} '
+              f'{result["latency_p99"]:>7.3f} {result["latency_max"]:>7.3f}')
+        calls = ', '.join(f'{method}={count}' for method, count in sorted(result['calls_by_method'].items()))
+        print(f'{"":<14} calls: {calls}')
+        old = before.get(result['scenario'])
+        if old:
+            print(f'{"":<14} vs baseline: parse/s {result["parse_lines_per_sec"]/old["parse_lines_per_sec"]:.2f}x, '
+                  f'calls {result["api_calls"]-old["api_calls"]:+d}, '
+                  f'p50 {result["latency_p50"]-old["latency_p50"]:+.3f}s, '
+                  f'p99 {result["latency_p99"]-old["latency_p99"]:+.3f}s')
+
+
+def main() -> int:
+    args = parse_args()
+
+    rng = random.Random(args.seed)
+    start = datetime(2026, 6, 11, 22, 0, 0)
+
+    if args.microbench is not None:
+        microbench(args.microbench, rng, start, args.verbose)
+        return 0
+
+    runs = []
+    for name in args.scenario or ([] if args.log else list(SCENARIOS)):
+        if name not in SCENARIOS:
+            sys.exit(f'Unknown scenario {name}, pick from: {", ".join(SCENARIOS)}')
+        runs.append((name, SCENARIOS[name](args.size, rng, start)))
+    for path in args.log:
+        runs.append((path.name, recorded(path, args.rate)))
+
+    results = []
+    for name, lines in runs:
+        print(f'Running {name} ({len(lines)} lines)...', file=sys.stderr, flush=True)
+        results.append(run_scenario(name, lines, args))
+
+    report(results, args.baseline)
+
+    if args.json is not None:
+        args.json.write_text(json.dumps(results, indent=2))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,4 +6,4 @@ cd $AUTOBUMPDIR
 
 GSHEETID=`cat $AUTOBUMPDIR/gsheet_test.id`
 
-tail -n 100  -f /home/ongbots/ongwatch/bump.log   | ./ongautobump.py --gsheets-credentials-file $AUTOBUMPDIR/gsheets_credentials.json --gsheets-id $GSHEETID --statefile test_state.txt
+./ongautobump.py --follow /home/ongbots/ongwatch/bump.log --gsheets-credentials-file $AUTOBUMPDIR/gsheets_credentials.json --gsheets-id $GSHEETID --statefile test_state.txt
@@ -0,0 +1,567 @@
+#!/usr/bin/env python3
+# Regression tests for the sheet write path, run against the local backend:
+#
+#   python -m unittest test_ongautobump
+import io
+import logging
+import queue
+import tempfile
+import threading
+import time
+import unittest
+from collections import Counter
+from pathlib import Path
+
+import ongautobump
+
+
+def bitslines(count):
+    return [f'2026-06-12 08:{i // 60:02d}:{i % 60:02d}\t\t\tmember{i}\tBits\t$0.{10 + i % 90:02d}\tna\t\n'
+            for i in range(count)]
+
+
+class SheetTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        ongautobump.metrics.reset()
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+    def session(self, sheet):
+        session = ongautobump.Session('test', sheet, Path(self.tmp.name) / 'state.txt')
+        session.row = 2
+        return session
+
+    def feed(self, session, lines):
+        for line in lines:
+            session.receive(line, ongautobump.classifyline(line), None)
+
+    def drain(self, session, tries=200):
+        # Keep flushing until nothing is left, the way writeloop does
+        for _ in range(tries):
+            with session.lock:
+                if not session.havepending():
+                    return
+            session.flushqueues()
+        self.fail('queue never drained')
+
+    def assertNoDuplicates(self, sheet, expected):
+        rows = [tuple(cells[:7]) for cells in sheet.cells[1:] if cells and cells[0]]
+        repeated = [row for row, count in Counter(rows).items() if count > 1]
+        self.assertEqual(repeated, [])
+        self.assertEqual(len(rows), expected)
+
+
+class FlushTest(SheetTestCase):
+    def test_failed_writes_are_not_duplicated(self):
+        sheet = ongautobump.LocalSheet(error_rate=0.5, seed=3)
+        session = self.session(sheet)
+        session.scheduler.backoff_base = 0.0
+        self.feed(session, bitslines(6))
+        self.drain(session)
+        self.assertNoDuplicates(sheet, 6)
+
+    def test_large_flush_written_once(self):
+        # More rows than the mirror remembers, all in one flush
+        sheet = ongautobump.LocalSheet(write_quota=1000, read_quota=1000)
+        session = self.session(sheet)
+        self.feed(session, bitslines(300))
+        self.drain(session)
+        self.assertNoDuplicates(sheet, 300)
+        self.assertEqual(session.row, 302)
+
+    def test_row_without_date_not_overwritten(self):
+        sheet = ongautobump.LocalSheet()
+        sheet.cells.append(['2026-06-12 07:00:00', '1', '', 'member', 'Bits', '$1.00', 'na'])
+        mod = ['', '', '', 'mod note: bob paid cash', 'Tip', '$20.00', 'na', 'keep me']
+        sheet.cells.append(list(mod))
+        session = self.session(sheet)
+        session.row = 3
+        self.feed(session, bitslines(1))
+        self.drain(session)
+        self.assertEqual(sheet.cells[2], mod)
+        self.assertEqual(sheet.cells[3][3], 'member0')
+
+
+    def test_same_line_twice_is_two_rows(self):
+        sheet = ongautobump.LocalSheet()
+        session = self.session(sheet)
+        line = bitslines(1)[0]
+        self.feed(session, [line, line, bitslines(2)[1]])
+        self.drain(session)
+        self.assertEqual([cells[3] for cells in sheet.cells[1:]], ['member0', 'member0', 'member1'])
+
+    def test_song_for_replayed_support(self):
+        # A restart reads the tip again, then the song request comes in
+        tip = '2026-06-08 23:55:56\t\t\tCOREYTOWNZ\tTip\t$55.55\tna\t\n'
+        song = 'SONG REQUEST FROM COREYTOWNZ: =HYPERLINK("https://youtu.be/X6QzbvH-ZNo", "The Addams Family Theme song")\n'
+        sheet = ongautobump.LocalSheet()
+        sheet.cells.append(tip.rstrip('\n').split('\t')[:7])
+        session = self.session(sheet)
+        session.row = 3
+        session.readtail(1)
+        self.feed(session, [tip, song])
+        self.drain(session)
+        self.assertNoDuplicates(sheet, 1)
+        self.assertEqual(sheet.cells[1][7], '=HYPERLINK("https://youtu.be/X6QzbvH-ZNo", "The Addams Family Theme song")')
+
+
+def filledsheet(rows, grid=1000, gaps=()):
+    # Rows 2 to rows+1 used, apart from the gaps
+    sheet = ongautobump.LocalSheet(read_quota=1000)
+    for rownum in range(2, rows + 2):
+        sheet.cells.append([] if rownum in gaps else ['2026-06-12 08:00:00', '1', '', f'member{rownum}', 'Bits', '$1.00', 'na'])
+    sheet.gridrows = max(grid, len(sheet.cells))
+    return sheet
+
+
+class LocateTailTest(unittest.TestCase):
+    def assertTail(self, sheet, hint, row, probes):
+        self.assertEqual(ongautobump.locatetail(sheet, hint), (row, probes))
+
+    def test_hint_right(self):
+        self.assertTail(filledsheet(100), 102, 102, 2)
+
+    def test_hint_below_end(self):
+        self.assertTail(filledsheet(100), 90, 102, 8)
+        self.assertTail(filledsheet(100), 2, 102, 14)
+
+    def test_hint_above_end(self):
+        self.assertTail(filledsheet(100), 150, 102, 12)
+
+    def test_hint_past_grid(self):
+        # Rows past row_count are known to be blank without reading them
+        self.assertTail(filledsheet(100, grid=120), 500, 102, 9)
+
+    def test_empty_sheet(self):
+        self.assertTail(filledsheet(0), 2, 2, 1)
+        self.assertTail(filledsheet(0), 50, 2, 10)
+
+    def test_full_grid(self):
+        self.assertTail(filledsheet(119, grid=120), 100, 121, 7)
+
+    def test_gap_above_hint(self):
+        # A blank row left in the middle of the sheet isn't the end of it
+        self.assertTail(filledsheet(100, gaps={51}), 102, 102, 2)
+        self.assertTail(filledsheet(100, gaps={51}), 95, 102, 6)
+
+    def test_row_without_date_is_used(self):
+        sheet = filledsheet(10)
+        sheet.cells.append(['', '', '', 'mod note', 'Tip', '$20.00', 'na'])
+        self.assertTail(sheet, 12, 13, 2)
+
+
+class SpoolTest(SheetTestCase):
+    def spooled(self, sheet):
+        session = ongautobump.Session('test', sheet, Path(self.tmp.name) / 'state.txt',
+                                      ongautobump.Spool(Path(self.tmp.name) / 'state.spool'))
+        session.restore()
+        return session
+
+    def test_rows_added_while_down_are_kept(self):
+        sheet = ongautobump.LocalSheet()
+        (Path(self.tmp.name) / 'state.txt').write_text('2')
+        lines = bitslines(10)
+        session = self.spooled(sheet)
+        self.feed(session, lines[:5])
+        self.drain(session)
+        session.close()
+
+        # Someone adds a row by hand before the restart
+        sheet.cells.append(['2026-06-12 09:00:00', '6', '', 'by hand', 'Tip', '$5.00', 'na'])
+
+        session = self.spooled(sheet)
+        self.feed(session, lines[5:])
+        self.drain(session)
+        session.close()
+        self.assertNoDuplicates(sheet, 11)
+        self.assertIn('by hand', [cells[3] for cells in sheet.cells if len(cells) > 3])
+
+    def test_spool_pruned_while_running(self):
+        sheet = ongautobump.LocalSheet(write_quota=1000)
+        (Path(self.tmp.name) / 'state.txt').write_text('2')
+        session = self.spooled(sheet)
+        session.spool.keeplines = session.spool.keeprows = 10
+        for i in range(0, 100, 5):
+            self.feed(session, bitslines(100)[i:i + 5])
+            self.drain(session)
+        db = session.spool.db
+        self.assertLessEqual(db.execute('SELECT COUNT(*) FROM lines').fetchone()[0], 10)
+        self.assertLessEqual(db.execute('SELECT COUNT(*) FROM events').fetchone()[0], 10)
+        session.close()
+        self.assertNoDuplicates(sheet, 100)
+
+    def test_waiting_songs_and_totals_survive_restart(self):
+        sheet = ongautobump.LocalSheet()
+        (Path(self.tmp.name) / 'state.txt').write_text('2')
+        session = self.spooled(sheet)
+        self.feed(session, [
+            '2026-06-12 08:00:00 === ONLINE (type=live @ 2026-06-12T12:00:00Z ===\n',
+            '2026-06-12 08:01:00\t\t\tTIPPER\tTip\t$20.00\tna\t\n',
+            'SONG REQUEST FROM EARLY: =HYPERLINK("https://youtu.be/X6QzbvH-ZNo", "Early song")\n',
+        ])
+        self.drain(session)
+        session.close()
+
+        session = self.spooled(sheet)
+        self.feed(session, [
+            'SONG REQUEST FROM TIPPER: =HYPERLINK("https://youtu.be/dQw4w9WgXcQ", "Late song")\n',
+            '2026-06-12 08:02:00\t\t\tEARLY\tBits\t$10.00\tna\t\n',
+            '2026-06-12 09:00:00 === OFFLINE ===\n',
+        ])
+        self.drain(session)
+        session.close()
+        rows = {cells[3]: cells for cells in sheet.cells[1:] if len(cells) > 3}
+        self.assertEqual(rows['TIPPER'][7], '=HYPERLINK("https://youtu.be/dQw4w9WgXcQ", "Late song")')
+        self.assertEqual(rows['EARLY'][7], '=HYPERLINK("https://youtu.be/X6QzbvH-ZNo", "Early song")')
+        self.assertEqual(rows['STREAM END'][7], 'Tip $20.00 (1), Bits $10.00 (1) | Top: TIPPER $20.00, EARLY $10.00'
+                                                 ' | Songs: 2 requested, 2 matched')
+
+
+streamlines = [
+    '2026-06-12 08:00:00 === ONLINE (type=live @ 2026-06-12T12:00:00Z ===\n',
+    '2026-06-12 08:01:00\t\t\tTIPPER\tTip\t$20.00\tna\t\n',
+    'SONG REQUEST FROM TIPPER: =HYPERLINK("https://youtu.be/X6QzbvH-ZNo", "Song")\n',
+    '2026-06-12 08:02:00\t\t\tsubber\tSub #49\t$5.00\tna\t\n',
+    '2026-06-12 08:03:00\t\tgifter\tsomeone\tSub\t$10.00\tna\t\n',
+    '2026-06-12 08:04:00\t\t\tbitser\tBits\t$1.00\tna\t\n',
+    'SONG REQUEST FROM bitser: =HYPERLINK("https://youtu.be/dQw4w9WgXcQ", "Other")\n',
+    '2026-06-12 08:05:00 === HYPE TRAIN END (level=4) ===\n',
+    '2026-06-12 09:00:00 === OFFLINE ===\n',
+]
+streamsummary = ('Tip $20.00 (1), Sub $15.00 (2), Bits $1.00 (1) | Top: TIPPER $20.00, gifter $10.00, subber $5.00'
+                 ' | Songs: 2 requested, 1 matched | Hype trains: 1, level 3')
+
+
+class StreamTotalsTest(SheetTestCase):
+    def streamend(self, sheet):
+        return [cells for cells in sheet.cells if len(cells) > 3 and cells[3] == 'STREAM END']
+
+    def test_stream_summary(self):
+        sheet = ongautobump.LocalSheet()
+        session = self.session(sheet)
+        self.feed(session, streamlines)
+        self.drain(session)
+        (end,) = self.streamend(sheet)
+        self.assertEqual(end[7], streamsummary)
+        self.assertTrue(session.totals.empty())
+
+    def test_replayed_lines_not_counted_twice(self):
+        # Killed halfway through the stream, then started again on the end
+        # of the log, which replays what was read after the stream started
+        sheet = ongautobump.LocalSheet()
+        (Path(self.tmp.name) / 'state.txt').write_text('2')
+        spool = lambda: ongautobump.Spool(Path(self.tmp.name) / 'state.spool')
+        session = ongautobump.Session('test', sheet, Path(self.tmp.name) / 'state.txt', spool())
+        session.restore()
+        self.feed(session, streamlines[:5])
+        self.drain(session)
+        session.close()
+
+        session = ongautobump.Session('test', sheet, Path(self.tmp.name) / 'state.txt', spool())
+        session.restore()
+        self.feed(session, streamlines[1:])
+        self.drain(session)
+        session.close()
+        (end,) = self.streamend(sheet)
+        self.assertEqual(end[7], streamsummary)
+        self.assertNoDuplicates(sheet, 7)
+
+
+class ImportTest(SheetTestCase):
+    def test_import(self):
+        logpath = Path(self.tmp.name) / 'bump.log'
+        logpath.write_text(''.join(bitslines(50)))
+        sheet = ongautobump.LocalSheet()
+        statefile = Path(self.tmp.name) / 'state.txt'
+        argv = ['--backend', 'local', '--statefile', str(statefile), '--line', '2', '--import', str(logpath)]
+        self.assertEqual(ongautobump.main(argv, sheet=sheet), 0)
+        self.assertNoDuplicates(sheet, 50)
+
+        # Importing the same log again adds nothing
+        self.assertEqual(ongautobump.main(argv, sheet=sheet), 0)
+        self.assertNoDuplicates(sheet, 50)
+
+    def test_song_for_row_already_in_sheet(self):
+        # The tip made it into the sheet before the song paid for by it did
+        tip = '2026-06-08 23:55:56\t\t\tCOREYTOWNZ\tTip\t$55.55\tna\t\n'
+        song = 'SONG REQUEST FROM COREYTOWNZ: =HYPERLINK("https://www.youtube.com/watch?v=X6QzbvH-ZNo", "The Addams Family Theme song")\n'
+        logpath = Path(self.tmp.name) / 'bump.log'
+        logpath.write_text(tip + song)
+        sheet = ongautobump.LocalSheet()
+        sheet.cells.append(tip.rstrip('\n').split('\t')[:7])
+        sheet.cells[1][1] = '1'
+        statefile = Path(self.tmp.name) / 'state.txt'
+        argv = ['--backend', 'local', '--statefile', str(statefile), '--line', '3', '--import', str(logpath)]
+        self.assertEqual(ongautobump.main(argv, sheet=sheet), 0)
+        self.assertNoDuplicates(sheet, 1)
+        self.assertEqual(sheet.cells[1][7], '=HYPERLINK("https://youtu.be/X6QzbvH-ZNo", "The Addams Family Theme song")')
+
+
+class SongMatcherTest(SheetTestCase):
+    def test_support_then_song(self):
+        matcher = ongautobump.SongMatcher()
+        matcher.addsupport('Bob', 5, 1000, None)
+        self.assertEqual(matcher.takesupport('bob')[:3], ['Bob', 5, 1000])
+        self.assertIsNone(matcher.takesupport('bob'))
+
+    def test_song_then_support(self):
+        matcher = ongautobump.SongMatcher()
+        first, second = ['Alice', 'one', False], ['Alice', 'two', False]
+        matcher.addsong(first)
+        matcher.addsong(second)
+        self.assertEqual(matcher.takesong('ALICE'), (first, []))
+        self.assertEqual(matcher.takesong('alice'), (second, []))
+        self.assertEqual(matcher.takesong('alice'), (None, []))
+
+    def test_names_case_folded(self):
+        matcher = ongautobump.SongMatcher()
+        matcher.addsupport('Straße', 5, 1000, None)
+        self.assertIsNotNone(matcher.takesupport('STRASSE'))
+
+    def test_expiry(self):
+        matcher = ongautobump.SongMatcher(expiry=60)
+        old, new = ['Alice', 'old', False], ['Alice', 'new', False]
+        matcher.addsong(old, now=0)
+        matcher.addsong(new, now=100)
+        self.assertEqual(matcher.takesong('alice', now=130), (new, [old]))
+        matcher.addsupport('Bob', 5, 1000, None, now=0)
+        self.assertIsNone(matcher.takesupport('bob', now=61))
+
+    def test_expired_song_leaves_notes(self):
+        sheet = ongautobump.LocalSheet()
+        session = self.session(sheet)
+        session.matcher.expiry = 60
+        self.feed(session, bitslines(1) + ['SONG REQUEST FROM nobody: =HYPERLINK("https://youtu.be/X6QzbvH-ZNo", "Song")\n'])
+        self.drain(session)
+        self.assertIn('QUEUED BY nobody', sheet.cells[2][7])
+        session.dropsongs(session.matcher.expire(now=time.time() + 61))
+        self.assertEqual(session.songqueue, [])
+        self.drain(session)
+        self.assertEqual(sheet.cells[2][7:], [''])
+
+
+class SongLinkTest(unittest.TestCase):
+    def assertLink(self, link, url, videoid):
+        self.assertEqual(ongautobump.parsesonglink(f'=HYPERLINK("{link}", "Title")'),
+                         ongautobump.SongLink(videoid, url, 'Title'))
+
+    def test_bare_id(self):
+        self.assertLink('X6QzbvH-ZNo', 'https://youtu.be/X6QzbvH-ZNo', 'X6QzbvH-ZNo')
+        self.assertLink('v=X6QzbvH-ZNo', 'https://youtu.be/X6QzbvH-ZNo', 'X6QzbvH-ZNo')
+
+    def test_tracking_and_playlist_dropped(self):
+        self.assertLink('https://www.youtube.com/watch?v=gut423ANiwo&list=RDgut423ANiwo&start_radio=1',
+                        'https://youtu.be/gut423ANiwo', 'gut423ANiwo')
+        self.assertLink('https://youtu.be/E9EarKleINw?si=UZfr46hQltMmvs1k', 'https://youtu.be/E9EarKleINw', 'E9EarKleINw')
+
+    def test_start_time_kept(self):
+        self.assertLink('https://www.youtube.com/watch?v=eY-eyZuW_Uk&t=95s', 'https://youtu.be/eY-eyZuW_Uk?t=95s', 'eY-eyZuW_Uk')
+
+    def test_shorts(self):
+        self.assertLink('youtube.com/shorts/S9zoPeH-Ly0', 'https://youtu.be/S9zoPeH-Ly0', 'S9zoPeH-Ly0')
+
+    def test_other_links_kept(self):
+        self.assertLink('https://open.spotify.com/track/abc?si=1', 'https://open.spotify.com/track/abc?si=1', None)
+        # Not a video id, so not made into a youtu.be link
+        self.assertLink('abc', 'abc', None)
+
+    def test_title_cleaned(self):
+        link = ongautobump.parsesonglink('=HYPERLINK("X6QzbvH-ZNo", "KIRBY KRACKLE "Ring"  (Green Lantern)")')
+        self.assertEqual(link.title, 'KIRBY KRACKLE Ring Green Lantern')
+
+    def test_not_a_hyperlink(self):
+        self.assertIsNone(ongautobump.parsesonglink('https://youtu.be/X6QzbvH-ZNo'))
+
+
+class FollowTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = Path(self.tmp.name) / 'bump.log'
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+    def follow(self, position):
+        # The follower never returns, so it is left polling in the background
+        self.lines = queue.Queue()
+        follower = ongautobump.LogFollower(self.path, position, interval=0.01)
+        threading.Thread(target=follower.follow, args=(self.lines,), daemon=True).start()
+        return follower
+
+    def take(self, count):
+        return [self.lines.get(timeout=5)[1:] for _ in range(count)]
+
+    def assertNothing(self):
+        with self.assertRaises(queue.Empty):
+            self.lines.get(timeout=0.1)
+
+    def test_resume_from_saved_position(self):
+        self.path.write_text('one\ntwo\nthree\n')
+        inode = self.path.stat().st_ino
+        self.follow((inode, 4))
+        self.assertEqual(self.take(2), [('two\n', (inode, 8)), ('three\n', (inode, 14))])
+        self.assertNothing()
+
+    def test_rotated_log_drained_first(self):
+        self.path.write_text('one\ntwo\n')
+        old = self.path.stat().st_ino
+        self.path.rename(self.path.with_name('bump.log.1'))
+        self.path.write_text('three\n')
+        new = self.path.stat().st_ino
+        self.follow((old, 4))
+        self.assertEqual(self.take(2), [('two\n', (old, 8)), ('three\n', (new, 6))])
+
+    def test_truncated_log_read_from_start(self):
+        self.path.write_text('one\ntwo\n')
+        inode = self.path.stat().st_ino
+        self.follow((inode, 0))
+        self.assertEqual(len(self.take(2)), 2)
+        self.path.write_text('new\n')
+        self.assertEqual(self.take(1), [('new\n', (inode, 4))])
+
+    def test_partial_line_held(self):
+        self.path.write_text('')
+        inode = self.path.stat().st_ino
+        self.follow((inode, 0))
+        with open(self.path, 'a') as log:
+            log.write('half a')
+            log.flush()
+            self.assertNothing()
+            log.write(' line\n')
+        self.assertEqual(self.take(1), [('half a line\n', (inode, 12))])
+
+    def test_state_file_round_trip(self):
+        statefile = Path(self.tmp.name) / 'state.txt'
+        session = ongautobump.Session('test', ongautobump.LocalSheet(), statefile)
+        session.row = 42
+        session.statepos = (1234, 5678)
+        session.writestate()
+        self.assertEqual(ongautobump.readstate(statefile), (42, (1234, 5678)))
+        session.statepos = None
+        session.writestate()
+        self.assertEqual(ongautobump.readstate(statefile), (42, None))
+
+
+class RateSchedulerTest(unittest.TestCase):
+    def test_bucket_refills(self):
+        bucket = ongautobump.TokenBucket(60, burst=2)
+        now = bucket.updated
+        bucket.take(2, now=now)
+        self.assertEqual(bucket.wait(now=now), 1.0)
+        self.assertEqual(bucket.wait(now=now + 0.5), 0.5)
+        self.assertEqual(bucket.wait(now=now + 10), 0.0)
+        self.assertEqual(bucket.tokens, 2)
+
+    def test_retry_after_honoured(self):
+        scheduler = ongautobump.RateScheduler()
+        now = time.monotonic()
+        self.assertEqual(scheduler.failed(ongautobump.SheetError(503, retry_after=30), now=now), 30)
+        self.assertEqual(scheduler.blocked_until, now + 30)
+        self.assertEqual(scheduler.wait('read', now=now + 10), 20)
+        self.assertFalse(scheduler.ready('write', now=now + 29))
+        self.assertTrue(scheduler.ready('write', now=now + 30))
+
+    def test_retry_after_header(self):
+        class Response:
+            headers = {'Retry-After': '7'}
+        error = Exception('rate limited')
+        error.response = Response()
+        self.assertEqual(ongautobump.RateScheduler().failed(error, now=time.monotonic()), 7)
+
+    def test_backoff_without_retry_after(self):
+        scheduler = ongautobump.RateScheduler(backoff_base=2.0, backoff_max=10.0)
+        for failures in range(1, 8):
+            self.assertLessEqual(scheduler.failed(ongautobump.SheetError(500)), min(10.0, 2.0 * 2 ** failures))
+        scheduler.succeeded()
+        self.assertEqual(scheduler.failures, 0)
+
+    def test_429_slows_down_then_recovers(self):
+        scheduler = ongautobump.RateScheduler(write_quota=60)
+        bucket = scheduler.buckets['write']
+        scheduler.failed(ongautobump.SheetError(429, retry_after=0), now=time.monotonic())
+        self.assertEqual(bucket.rate, 0.5)
+        self.assertLessEqual(bucket.tokens, 0)
+        scheduler.failed(ongautobump.SheetError(429, retry_after=0), now=time.monotonic())
+        self.assertEqual(bucket.rate, 0.25)
+        scheduler.succeeded()
+        self.assertEqual(bucket.rate, 0.3)
+        for _ in range(20):
+            scheduler.succeeded()
+        self.assertEqual(bucket.rate, 1.0)
+
+    def test_429_slowdown_has_a_floor(self):
+        bucket = ongautobump.TokenBucket(60)
+        for _ in range(10):
+            bucket.slowdown()
+        self.assertAlmostEqual(bucket.rate, 0.1)
+
+
+class FlushPolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.policy = ongautobump.FlushPolicy(min_delay=0.25, max_delay=5.0, idle=0.5, size=100)
+
+    def test_size(self):
+        self.assertEqual(self.policy.due(100, oldest=10.0, lastline=10.0, now=10.0), (0.0, 'size'))
+
+    def test_held_while_lines_keep_coming(self):
+        self.assertEqual(self.policy.due(5, oldest=10.0, lastline=12.0, now=12.0), (0.5, None))
+
+    def test_idle(self):
+        self.assertEqual(self.policy.due(5, oldest=10.0, lastline=10.5, now=11.0), (0.0, 'idle'))
+
+    def test_min_delay(self):
+        # Quiet since the row came in, but not for min_delay yet
+        self.assertEqual(self.policy.due(1, oldest=10.0, lastline=9.0, now=10.125), (0.125, None))
+
+    def test_max_delay(self):
+        self.assertEqual(self.policy.due(5, oldest=10.0, lastline=14.9, now=15.0), (0.0, 'max_delay'))
+        # The hold never runs past max_delay
+        self.assertEqual(self.policy.due(5, oldest=10.0, lastline=14.75, now=14.75), (0.25, None))
+
+
+class HandoverTest(unittest.TestCase):
+    def test_full_queue_logged_once_each_way(self):
+        lines = queue.Queue(maxsize=2)
+        with self.assertLogs('ongautobump', logging.INFO) as logs:
+            full = False
+            for item in range(6):
+                if lines.full():
+                    threading.Timer(0.01, lines.get).start()
+                full = ongautobump.handover(lines, item, full)
+            self.assertTrue(full)
+            lines.get()
+            full = ongautobump.handover(lines, 6, full)
+        self.assertFalse(full)
+        self.assertEqual([(record.levelname, record.getMessage().split(':')[0]) for record in logs.records],
+                         [('WARNING', 'Input queue full, waiting for the sheet to catch up'),
+                          ('INFO', 'Input queue caught up')])
+
+
+class RateLimitTest(unittest.TestCase):
+    def write(self, messages):
+        stream = io.StringIO()
+        logger = logging.getLogger('ongautobump.test')
+        logger.propagate = False
+        handler = ongautobump.LogWriter(stream, logging.Formatter('%(message)s'), ongautobump.RateLimit(burst=3))
+        logger.addHandler(handler)
+        try:
+            for message in messages:
+                logger.info(message)
+        finally:
+            logger.removeHandler(handler)
+            handler.close()
+        return stream.getvalue().splitlines()
+
+    def test_different_messages_all_logged(self):
+        messages = [f'Adding Entry: member{i}' for i in range(50)]
+        self.assertEqual(self.write(messages), messages)
+
+    def test_repeats_counted_on_close(self):
+        lines = self.write(['Retrying'] * 10 + ['Done'])
+        self.assertEqual(lines, ['Retrying'] * 3 + ['Done', 'Retrying (7 more like this not logged)'])
+
+
+if __name__ == '__main__':
+    unittest.main()